@@ -6,7 +6,9 @@
    python update_retraction_table.py -c [cohort]] -m [version comment]
 """
 import argparse
+import json
 import logging
+import numpy
 import pandas
 import sys
 
@@ -18,20 +20,52 @@ RETRACTION_TABLE_ID = "syn52915299"
 RELEASE_INFO_ID = "syn27628075"
 BPC_PT_TABLE_ID = "syn21446700"
 
-def download_synapse_table(syn, table_id, condition):
+def _format_sql_value(value):
+    """Format a value as a Synapse SQL literal"""
+    if isinstance(value, (list, tuple, set)):
+        return("(%s)" % ", ".join(_format_sql_value(val) for val in value))
+    if isinstance(value, (bool, numpy.bool_)):
+        return("true" if value else "false")
+    if isinstance(value, (int, float, numpy.number)):
+        return(str(value))
+    return("'%s'" % str(value).replace("'", "''"))
+
+def build_table_query(table_id, columns=None, condition=None):
+    """Build a Synapse table query that only selects the given columns and rows
+
+    Args:
+        table_id: Synapse ID of a table
+        columns (list): columns to select. Optional, all columns by default.
+        condition: condition for querying the table, either as SQL or as a
+            dict of column to value. A column matches any value of a list.
+            Optional.
+
+    Returns:
+        String: Synapse table query
+    """
+    query = "SELECT %s FROM %s" % (", ".join(columns) if columns else "*", table_id)
+    if isinstance(condition, dict):
+        condition = " AND ".join(
+            "%s %s %s" % (col, "IN" if isinstance(value, (list, tuple, set)) else "=", _format_sql_value(value))
+            for col, value in condition.items())
+    if condition:
+        query += " WHERE " + condition
+    return(query)
+
+def download_synapse_table(syn, table_id, condition, columns=None):
     """Download Synapse Table with the given table ID and condition
     
     Args:
         syn: Synapse credential
         table_id: Synapse ID of a table
-        condition: additional condition for querying the table
+        condition: additional condition for querying the table, either as
+            SQL or as a dict of column to value
+        columns (list): columns to select. Optional, all columns by default.
     
     Returns:
         Dataframe: synapse table
     """
-    if condition:
-        condition = " WHERE "+condition
-    synapse_table = syn.tableQuery("SELECT * from %s%s" % (table_id,condition))
+    synapse_table = syn.tableQuery(build_table_query(table_id, columns, condition))
     synapse_table = synapse_table.asDataFrame()
     return(synapse_table)
 
@@ -76,7 +110,7 @@ def update_version(syn, table_id, comment):
     """
     Update the table version with given table ID and comment
     """
-    syn.restPOST("/entity/%s/table/snapshot" % table_id, body='{"snapshotComment":"%s"}' % comment)
+    syn.restPOST("/entity/%s/table/snapshot" % table_id, body=json.dumps({"snapshotComment": comment}))
 
 def get_file_id_by_name(syn, folder_id, file_name):
     """Get file synapse ID by name while the parent folder is given
@@ -141,13 +175,13 @@ def main():
     logger.info('Updating BPC retraction for release table on Synapse!')
     
     #read the BPC patient table and get 89+ patients for the cohort
-    bpc_cohort_patient = download_synapse_table(syn, BPC_PT_TABLE_ID, "cohort='"+cohort+"'")
+    bpc_cohort_patient = download_synapse_table(syn, BPC_PT_TABLE_ID, {'cohort': cohort}, ['record_id', 'redacted'])
     cohort_patient_list = list(bpc_cohort_patient['record_id'])
     redacted_patient = bpc_cohort_patient[bpc_cohort_patient['redacted']=="Yes"]
     redacted_patient_list = list(redacted_patient['record_id'])
     
     #read release info
-    release_info = download_synapse_table(syn, RELEASE_INFO_ID, "cohort='"+cohort+"' and current=True")
+    release_info = download_synapse_table(syn, RELEASE_INFO_ID, {'cohort': cohort, 'current': True}, ['main_genie_release'])
     
     #load the main GENIE release
     main_genie_release_folder = release_info['main_genie_release'].values[0]
@@ -158,7 +192,7 @@ def main():
     main_genie_patient_list = list(set(clinical_pt_from_sample.iloc[5:]['patient_id']))
    
     #load the existing redacted patient list
-    current_redacted = download_synapse_table(syn, RETRACTION_TABLE_ID, "cohort='"+cohort+"'")
+    current_redacted = download_synapse_table(syn, RETRACTION_TABLE_ID, {'cohort': cohort}, ['patient_id'])
     current_patient_list = list(current_redacted['patient_id'])
     
     new_redacted_df = pandas.DataFrame()
@@ -16,7 +16,6 @@ python update_table_update.py -m [version_message] irr
 """
 
 import argparse
-import datetime
 import json
 import math
 
@@ -111,17 +110,8 @@ def _to_redact_birth_year(df_col_birth_year, df_col_dt_compare, df_col_vital_sta
     Returns:
         tuple: pandas.core.indexes: to redact index in Dataframe
     """
-    df_col_birth_year = pandas.to_numeric(df_col_birth_year, downcast='integer',errors='coerce')
-    if len(df_col_dt_compare)==0:
-        df_col_dt_compare = datetime.date.today()
-    else:
-        df_col_dt_compare = df_col_dt_compare.fillna(datetime.datetime.now().strftime("%Y-%m-%d"))  
-        df_col_dt_compare = df_col_dt_compare.apply(lambda x: datetime.datetime.strptime(str(x),"%Y-%m-%d").date())
-    dates_diff = df_col_dt_compare - df_col_birth_year.apply(lambda x: datetime.date(x, 1, 1))
-    date_diff_bool = dates_diff.dt.days > get_phi_cutoff("day")
-    vital_status_bool = df_col_vital_status == 'No'
-    to_redact = date_diff_bool & vital_status_bool
-    return to_redact[to_redact].index
+    to_redact = birth_year_redaction_mask(df_col_birth_year, df_col_dt_compare, df_col_vital_status, get_phi_cutoff("day"))
+    return df_col_birth_year.index[to_redact]
 
 def _to_redact_seq_age(df_col_seq_age, df_col_vital_status):
     """
@@ -1,6 +1,9 @@
+import datetime
+import json
 import logging
 import sys
 
+import numpy
 import pandas
 import synapseclient
 from synapseclient import Schema, Column, Table
@@ -41,6 +44,33 @@ def check_empty_row(row, cols_to_skip):
     """
     return row.drop(cols_to_skip).isnull().all()
 
+def birth_year_redaction_mask(birth_year, date_compare, vital_status, cutoff_days):
+    """Determine which patients are alive and older than the cutoff as of the date to compare
+
+    The dates are compared as numpy datetime64 arrays. A missing birth year is
+    taken as 1900 and a missing date to compare as today.
+
+    Args:
+        birth_year (pandas.Series): birth years
+        date_compare (pandas.Series): dates to compare in %Y-%m-%d format
+        vital_status (pandas.Series): "Yes" if deceased, "No" if alive
+        cutoff_days (int): largest age in days that is not redacted
+
+    Returns:
+        numpy.ndarray: boolean mask of the patients to redact
+    """
+    today = numpy.datetime64(datetime.date.today(), "D")
+    if len(date_compare) == 0:
+        date_compare = numpy.full(len(birth_year), today)
+    else:
+        date_compare = pandas.to_datetime(numpy.asarray(date_compare), format="%Y-%m-%d")
+        date_compare = date_compare.values.astype("datetime64[D]")
+        date_compare[numpy.isnat(date_compare)] = today
+    birth_year = pandas.to_numeric(pandas.Series(birth_year)).astype(float).fillna(1900)  # arbitrary year > 89 yrs old
+    birth_date = (birth_year.to_numpy().astype("int64") - 1970).astype("datetime64[Y]").astype("datetime64[D]")
+    age_days = (date_compare - birth_date).astype("int64")
+    return((age_days > cutoff_days) & (pandas.Series(vital_status) == "No").to_numpy())
+
 def download_synapse_table(syn, table_id, condition):
     """Download Synapse Table with the given table ID and condition
     
@@ -114,7 +144,7 @@ def update_version(syn, table_id, comment):
     """
     Update the table version with given table ID and comment
     """
-    syn.restPOST("/entity/%s/table/snapshot" % table_id, body='{"snapshotComment":"%s"}' % comment)
+    syn.restPOST("/entity/%s/table/snapshot" % table_id, body=json.dumps({"snapshotComment": comment}))
     
 def revert_table_version(syn, table_id):
     """Revert table data to previous version
@@ -20,9 +20,10 @@ def set_up(args):
         args: argument from input
 
     Returns:
-        list: dry run flag, synapse login, and logger
+        list: dry run flag, synapse login, logger and cache of Synapse downloads
     """
     dry_run = args.dry_run
+    cache = SynapseCache(args.cache_dir) if args.cache_dir else None
 
     #login to synapse
     syn = synapse_login(args.synapse_config)
@@ -31,13 +32,13 @@ def set_up(args):
     logger_name = "testing" if dry_run else "production"
     logger = setup_custom_logger(logger_name)
     logger.info('Updating BPC data element catalog!')
-    return dry_run, syn, logger
+    return dry_run, syn, logger, cache
 
-def _get_dd_info(syn, version):
+def _get_dd_info(syn, version, cache=None):
     """
     Get the non-PHI data dictionary Synapse ID and cohort by version number
     """
-    prissmm_info = syn.tableQuery("SELECT id, name, cohort FROM syn22684834 WHERE name=\'%s\'" % version).asDataFrame()
+    prissmm_info = download_synapse_table(syn, "syn22684834", {'name': version}, cache, columns=['id', 'name', 'cohort'])
     #TODO: error message if the version does not exist
     for file_info in syn.getChildren(prissmm_info['id'][0]):
         if file_info['name'] == "Data Dictionary non-PHI":
@@ -138,15 +139,17 @@ def _update_by_data_dictionary(data_dictionary, data_element_catalog, logger):
 # combine the add/update/remove into one syn.store
 # determine the procedure for variables of removal
 def update_by_data_dictionary(args):
-    dry_run, syn, logger = set_up(args)
-    dd_syn_id, cohort = _get_dd_info(syn, args.version)
-    data_dictionary = pandas.read_csv(syn.get(dd_syn_id).path,
-                                      usecols=[0,1,3,4,5,7],
-                                      header=0, 
-                                      names=["variable","instrument","type","label","choices","validation"]
-                                      )
-    curated_var_catalog = syn.tableQuery("SELECT variable, synColSize, numCols \
-        FROM %s WHERE dataType='curated'" % CATALOG_ID).asDataFrame()
+    dry_run, syn, logger, cache = set_up(args)
+    dd_syn_id, cohort = _get_dd_info(syn, args.version, cache)
+    data_dictionary = cached_read_file(syn, dd_syn_id,
+                                       lambda path: pandas.read_csv(path,
+                                                                    usecols=[0,1,3,4,5,7],
+                                                                    header=0, 
+                                                                    names=["variable","instrument","type","label","choices","validation"]
+                                                                    ),
+                                       cache)
+    curated_var_catalog = download_synapse_table(syn, CATALOG_ID, {'dataType': 'curated'}, cache,
+                                                 columns=['variable', 'synColSize', 'numCols'])
     curated_var_catalog.index = curated_var_catalog.index.map(str)
     curated_var_catalog['index'] = curated_var_catalog.index
     vars_to_add_df, vars_to_rm_df, vars_to_update_df = \
@@ -162,18 +165,21 @@ def update_by_data_dictionary(args):
             vars_to_add_df = _create_new_row(vars_to_add_df, cohort)
             vars_to_add_df = syn.store(Table(CATALOG_ID, vars_to_add_df))
 
-def download_bpc_sor(syn, logger):
+def download_bpc_sor(syn, logger, cache=None):
     """Download the BPC Scope of Release
 
     Args:
         syn (Object): Synapse Credential
         logger (Object): logger for tracking
+        cache (SynapseCache): cache of Synapse downloads. Optional.
 
     Returns:
         pandas.DataFrame: Scope of Release
     """
     logger.info("Downloading BPC Scope of Release...")
-    sor = pandas.read_excel(syn.get(SOR_ID).path, sheet_name="Data Dictionary")
+    sor = cached_read_file(syn, SOR_ID,
+                           lambda path: pandas.read_excel(path, sheet_name="Data Dictionary"),
+                           cache)
     # get the list of columns we need
     sor.columns = sor.columns.str.lower()
     sor = sor.filter(regex='^varname|^type|dataset|display name|shared|cbio')
@@ -310,13 +316,12 @@ def _update_by_release_scope(sor_formatted, data_element_catalog, logger):
     return vars_to_add_df, vars_to_rm, vars_to_update_df
     
 def update_by_release_scope(args):
-    dry_run, syn, logger = set_up(args)
-    sor = download_bpc_sor(syn, logger)
-    release_info = syn.tableQuery("SELECT cohort, release_version, release_type \
-                                   FROM syn27628075 \
-                                   WHERE current is true").asDataFrame()
+    dry_run, syn, logger, cache = set_up(args)
+    sor = download_bpc_sor(syn, logger, cache)
+    release_info = download_synapse_table(syn, "syn27628075", {'current': True}, cache,
+                                          columns=['cohort', 'release_version', 'release_type'])
     sor_formatted = format_bpc_sor(sor, release_info, logger)
-    data_element_catalog_query = syn.tableQuery("SELECT * FROM %s" % CATALOG_ID)
+    data_element_catalog_query = syn.tableQuery(build_table_query(CATALOG_ID))
     data_element_catalog = data_element_catalog_query.asDataFrame()
     vars_to_add_df, vars_to_rm_df, vars_to_update_df = \
         _update_by_release_scope(sor_formatted, data_element_catalog, logger)
@@ -355,6 +360,11 @@ def main():
         action="store_true",
         help="dry run flag"
     )
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        help="Directory to cache Synapse downloads between runs"
+    )
     
     if len(sys.argv) <= 1:
         sys.argv.append('--help')
@@ -15,9 +15,14 @@ python update_table_update.py -m [version_message] irr
 """
 
 import argparse
-import datetime
+import atexit
 import json
 import math
+import os
+import shutil
+import tempfile
+import threading
+import time
 
 import pandas
 import numpy
@@ -28,6 +33,20 @@ TABLE_INFO = {
     "primary": ("syn23285911", "table_type='data'"),
     "irr": ("syn21446696", "table_type='data' and double_curated is true"),
 }
+DATA_ELEMENT_CATALOG_ID = "syn21431364"
+# columns identifying a row of the data tables
+ROW_KEY_COLUMNS = ["cohort", "record_id", "redcap_repeat_instance"]
+# columns only filled by the redaction, kept as they are when the rows of the
+# full tables are compared
+REDACTION_COLUMNS = ["redacted"]
+# maximum in-memory size of the rows stored in one table transaction
+UPLOAD_CHUNK_BYTES = 64 * 1024**2
+# maximum number of chunks of a table uploaded concurrently
+UPLOAD_WORKERS = 4
+# maximum number of chunks uploaded concurrently over all tables, as the
+# tables are also updated concurrently
+MAX_CONCURRENT_UPLOADS = 8
+_UPLOAD_SLOTS = threading.BoundedSemaphore(MAX_CONCURRENT_UPLOADS)
 
 
 def get_main_genie_clinical_sample_file(
@@ -35,6 +54,7 @@ def get_main_genie_clinical_sample_file(
     release: str,
     release_files_table_synid: str,
     logger: logging.Logger = None,
+    cache: SynapseCache = None,
 ) -> pandas.DataFrame:
     """This retrieves the main genie clinical sample file from consortium release
 
@@ -44,19 +64,31 @@ def get_main_genie_clinical_sample_file(
         release_files_table_synid (str): synapse id of the data relese files table
         from main genie
         logger (logging.Logger): custom logger. Optional.
+        cache (SynapseCache): local cache of Synapse downloads. Optional.
 
     Returns:
         pandas.DataFrame: the read in clinical file as dataframe
     """
-    release_files = syn.tableQuery(
-        f"SELECT * FROM {release_files_table_synid}"
-    ).asDataFrame()
-    clinical_link_synid = release_files[
-        (release_files["release"] == release)
-        & (release_files["name"] == "data_clinical_sample.txt")
-    ]["fileSynId"].values[0]
-    clinical_ent = syn.get(clinical_link_synid, followLink=True)
-    clinical_df = pandas.read_csv(clinical_ent.path, sep="\t", skiprows=4)
+    release_files = download_synapse_table(
+        syn,
+        release_files_table_synid,
+        {"release": release, "name": "data_clinical_sample.txt"},
+        cache,
+        columns=["fileSynId"],
+    )
+    clinical_link_synid = release_files["fileSynId"].values[0]
+    clinical_df = cached_read_file(
+        syn,
+        clinical_link_synid,
+        lambda path: pandas.read_csv(
+            path,
+            sep="\t",
+            skiprows=4,
+            usecols=lambda col: col in ["SAMPLE_ID", "SEQ_YEAR"],
+        ),
+        cache,
+        follow_link=True,
+    )
     assert (
         not clinical_df.empty
     ), f"Clinical file pulled from {clinical_link_synid} link is empty."
@@ -70,22 +102,168 @@ def get_main_genie_clinical_sample_file(
     return clinical_df[["SAMPLE_ID", "SEQ_YEAR"]]
 
 
-def _store_data(syn, table_id, label_data, table_type, logger, dry_run):
-    table_schema = syn.get(table_id)
+def _update_table_rows(
+    syn, table_schema, table_query, new_data, logger, kept_columns=None
+):
+    """Update a table with only the rows that differ from the new data
+
+    Rows are matched by ROW_KEY_COLUMNS and compared by the hash of their
+    content. The table is wiped and reloaded if the rows can not be
+    matched by key.
+
+    Args:
+        syn (synapseclient.Synapse): synapse client connection
+        table_schema (synapseclient.Schema): schema of the table
+        table_query (synapseclient.table.CsvFileTable): SELECT * query of the table
+        new_data (pandas.DataFrame): new data of the table
+        logger (logging.Logger): logger
+        kept_columns (list): columns whose current values are kept for the
+            rows already in the table. Optional.
+
+    Returns:
+        int: in-memory size in bytes of the rows sent to Synapse
+    """
+    key_columns = [col for col in ROW_KEY_COLUMNS if col in new_data.columns]
+    diff = diff_table_rows(
+        table_query.asDataFrame(), new_data, key_columns, kept_columns
+    )
+    if diff is None:
+        logger.info("Rows can not be matched by key, reloading the table")
+        syn.delete(table_query.asRowSet())  # wipe the table
+        return _store_rows(syn, table_schema, new_data, logger)
+    to_insert, to_update, to_delete = diff
+    logger.info(
+        f"Rows to insert: {len(to_insert)}, update: {len(to_update)}, "
+        f"delete: {len(to_delete)}"
+    )
+    # the etag of the query is only valid before any other change
+    size = _store_rows(syn, table_schema, to_update, logger, etag=table_query.etag)
+    if not to_delete.empty:
+        syn.delete(Table(table_schema, to_delete[key_columns]))
+    return size + _store_rows(syn, table_schema, to_insert, logger)
+
+
+def _frame_bytes(df):
+    return int(df.memory_usage(deep=True).sum())
+
+
+def _split_rows(df, chunk_bytes, group_column=None):
+    """Split data into chunks of rows of at most about chunk_bytes in memory
+
+    With a group column, all rows of a group are in the same chunk, which
+    may then be larger than chunk_bytes.
+    """
+    rows_per_chunk = max(1, len(df) * chunk_bytes // max(1, _frame_bytes(df)))
+    if group_column is None:
+        return [
+            df.iloc[start : start + rows_per_chunk]
+            for start in range(0, len(df), rows_per_chunk)
+        ]
+    df = df.sort_values(group_column, kind="stable")
+    groups = df[group_column].values
+    chunks = []
+    start = 0
+    while start < len(df):
+        end = min(start + rows_per_chunk, len(df))
+        # extend the chunk to the last row of its last group
+        while end < len(df) and groups[end] == groups[end - 1]:
+            end += 1
+        chunks.append(df.iloc[start:end])
+        start = end
+    return chunks
+
+
+def _store_rows(
+    syn,
+    table_schema,
+    df,
+    logger,
+    etag=None,
+    chunk_bytes=UPLOAD_CHUNK_BYTES,
+    workers=UPLOAD_WORKERS,
+    group_column=None,
+):
+    """Store rows of a table in size-bounded chunks uploaded concurrently
+
+    Every chunk is stored in its own transaction, so a failed upload only
+    costs its chunk: the other chunks are committed and the next run only
+    sends the rows that still differ. Chunks are not retried, because a
+    chunk whose response is lost may already be committed. The first
+    chunk is stored before the others because the etag is only valid
+    before any other change of the table. Tables updated concurrently share
+    MAX_CONCURRENT_UPLOADS, so the overall number of uploads is bounded.
+
+    Args:
+        syn (synapseclient.Synapse): synapse client connection
+        table_schema (synapseclient.Schema): schema of the table
+        df (pandas.DataFrame): rows to store
+        logger (logging.Logger): logger
+        etag (str): etag of the table query of updated rows. Optional.
+        chunk_bytes (int): maximum in-memory size of a chunk in bytes
+        workers (int): maximum number of chunks uploaded concurrently
+        group_column (str): column whose rows with the same value are
+            stored in the same chunk. Optional.
+
+    Returns:
+        int: in-memory size in bytes of the stored rows
+    """
+    if df.empty:
+        return 0
+    start = time.time()
+    chunks = _split_rows(df, chunk_bytes, group_column)
+
+    def _store_chunk(i, chunk_logger):
+        kwargs = {"etag": etag} if i == 0 and etag is not None else {}
+        with _UPLOAD_SLOTS:
+            syn.store(Table(table_schema, chunks[i], **kwargs))
+
+    _store_chunk(0, logger)
+    if len(chunks) > 1:
+        run_concurrently(
+            _store_chunk,
+            range(1, len(chunks)),
+            workers,
+            logger,
+            description="row chunks",
+        )
+    size = _frame_bytes(df)
+    elapsed = max(time.time() - start, 1e-6)
+    logger.info(
+        "Stored %s rows (%.1f MB) in %s chunks in %.1f s, %.1f MB/s"
+        % (len(df), size / 1024**2, len(chunks), elapsed, size / 1024**2 / elapsed)
+    )
+    return size
+
+
+def _store_data(
+    syn,
+    table_id,
+    label_data,
+    table_type,
+    logger,
+    dry_run,
+    record_index=None,
+    output_format="csv",
+    fingerprints=None,
+    cohorts=None,
+    registry=None,
+):
+    if registry is None:
+        registry = TableSchemaRegistry(syn)
+    table_schema = registry.get(table_id)
     logger.info(f"Updating table: {table_schema.name} {table_id}")
     form_label = table_schema.form_label[0]
-    table_columns = syn.getColumns(table_schema.columnIds)
-    table_columns = [col["name"] for col in list(table_columns)]
-    table_columns = list(
-        set(table_columns) & set(label_data.columns)
-    )  # variable in dd but not in data
-    table_columns.append("redcap_repeat_instrument")
-    temp_data = label_data[table_columns]
-    if form_label == "non-repeating":
-        temp_data = temp_data[temp_data.redcap_repeat_instrument.isnull()]
-    else:
-        temp_data = temp_data[temp_data.redcap_repeat_instrument == form_label]
-    temp_data.drop(columns="redcap_repeat_instrument", inplace=True)
+    table_columns = [
+        col
+        for col in registry.get_column_names(table_id)
+        if col != "redcap_repeat_instrument"
+    ]
+    # variable in dd but not in data
+    table_columns = label_data.get_table_columns(table_columns)
+    temp_data = label_data.get_form_data(form_label, table_columns)
+    if cohorts is not None:
+        other_cohorts = ~temp_data["cohort"].isin(cohorts)
+        temp_data.drop(index=temp_data.index[other_cohorts], inplace=True)
     # remove rows with no data
     cols_to_skip = ["cohort", "record_id", "redcap_data_access_group"]
     if "redcap_repeat_instance" in table_columns:
@@ -97,30 +275,125 @@ def _store_data(syn, table_id, label_data, table_type, logger, dry_run):
             cols_to_skip = ["cohort", "record_id", "redcap_repeat_instance"]
         else:
             cols_to_skip.append("redcap_repeat_instance")
-    rows_to_drop = temp_data.index[
-        temp_data.apply(lambda row: check_empty_row(row, cols_to_skip), axis=1)
-    ]
-    temp_data.drop(index=rows_to_drop, inplace=True)
+    with STAGE_METRICS.stage("empty_row_filter", table_id) as record:
+        record["rows"], record["columns"] = temp_data.shape
+        rows_to_drop = temp_data.index[check_empty_rows(temp_data, cols_to_skip)]
+        temp_data.drop(index=rows_to_drop, inplace=True)
     # remove .0 from all columns
-    temp_data = temp_data.applymap(lambda x: float_to_int(x))
+    with STAGE_METRICS.stage("float_normalization", table_id) as record:
+        record["rows"], record["columns"] = temp_data.shape
+        temp_data = float_to_int_df(temp_data)
     # update table
-    table_query = syn.tableQuery("SELECT * from %s" % table_id)
     if table_type == "irr":
         # check for exsiting id to update for new data only
-        existing_records = list(set(table_query.asDataFrame()["record_id"]))
+        if record_index is None:
+            record_index = RecordIdIndex()
+        existing_records = record_index.get_record_ids(syn, table_id)
         temp_data = temp_data[~temp_data["record_id"].isin(existing_records)]
-    if not dry_run:
-        if table_type == "primary":
-            table = syn.delete(table_query.asRowSet())  # wipe the table
-        table = syn.store(Table(table_schema, temp_data))
+    if (
+        not dry_run
+        and table_type == "primary"
+        and cohorts is None
+        and fingerprints is not None
+        and not fingerprints.has_changed(table_schema, temp_data)
+    ):
+        logger.info("Table is unchanged since its last snapshot, skipping upload")
+    elif not dry_run:
+        with STAGE_METRICS.stage("upload", table_id) as record:
+            record["rows"], record["columns"] = temp_data.shape
+            if table_type == "primary":
+                # only the rows of the reloaded cohorts are rewritten
+                condition = None if cohorts is None else {"cohort": list(cohorts)}
+                table_query = syn.tableQuery(
+                    build_table_query(table_id, condition=condition)
+                )
+                kept_columns = [
+                    col for col in REDACTION_COLUMNS if col in temp_data.columns
+                ]
+                record["bytes"] = _update_table_rows(
+                    syn, table_schema, table_query, temp_data, logger, kept_columns
+                )
+            else:
+                # the next run only appends the records that are not in the
+                # table, so a record is never split across chunks
+                record["bytes"] = _store_rows(
+                    syn, table_schema, temp_data, logger, group_column="record_id"
+                )
+    elif output_format == "parquet":
+        # the whole numbers of float columns are now text
+        to_arrow_compatible(temp_data.copy()).to_parquet(table_id + "_temp.parquet")
     else:
         temp_data.to_csv(table_id + "_temp.csv")
+    return temp_data
 
 
-def store_data(syn, master_table, label_data, table_type, logger, dry_run):
+def store_data(
+    syn,
+    master_table,
+    label_data,
+    table_type,
+    logger,
+    dry_run,
+    workers=1,
+    record_index=None,
+    output_format="csv",
+    manifest=None,
+    fingerprints=None,
+    cohorts=None,
+    registry=None,
+):
+    """Update the data tables with the label data
+
+    Tables already stored according to the run manifest are skipped, and
+    primary tables unchanged according to their fingerprint are not uploaded.
+    If cohorts are given, only the rows of these cohorts are rewritten. Dry
+    runs are not recorded in the manifest.
+
+    Returns:
+        dict: table ID to the data stored in the table
+    """
     logger.info("Updating data for %s tables..." % table_type)
-    for table_id in master_table["id"]:
-        _store_data(syn, table_id, label_data, table_type, logger, dry_run)
+    table_ids = _tables_to_do(master_table["id"], "stored", manifest, logger)
+
+    def _store_table(table_id, table_logger):
+        temp_data = _store_data(
+            syn,
+            table_id,
+            label_data,
+            table_type,
+            table_logger,
+            dry_run,
+            record_index,
+            output_format,
+            fingerprints,
+            cohorts,
+            registry,
+        )
+        if manifest is not None and not dry_run:
+            manifest.set_done(table_id, "stored")
+        return temp_data
+
+    return run_concurrently(
+        _store_table,
+        table_ids,
+        workers,
+        logger,
+        description="%s tables" % table_type,
+    )
+
+
+def _tables_to_do(table_ids, phase, manifest, logger):
+    """Get the tables that did not complete a phase according to the manifest"""
+    if manifest is None:
+        return list(table_ids)
+    to_do = [
+        table_id for table_id in table_ids if not manifest.is_done(table_id, phase)
+    ]
+    if len(to_do) < len(table_ids):
+        logger.info(
+            "Skipping %s tables already %s" % (len(table_ids) - len(to_do), phase)
+        )
+    return to_do
 
 
 def get_phi_cutoff(unit):
@@ -128,23 +401,51 @@ def get_phi_cutoff(unit):
     return switcher.get(unit, "Invalid unit")
 
 
-def _to_redact_interval(df_col, unit):
+def get_interval_cutoffs(interval_cols_info):
+    """Get the PHI cutoff of every interval variable
+
+    A variable with an invalid unit has no cutoff, which only fails the
+    redaction of a table that has the variable.
+
+    Args:
+        interval_cols_info: Dataframe of interval variables and their unit
+
+    Returns:
+        dict: interval variable to its cutoff, None for an invalid unit
+    """
+    cutoffs = {}
+    for variable, unit in zip(
+        interval_cols_info["variable"], interval_cols_info["unit"]
+    ):
+        cutoff = get_phi_cutoff(unit)
+        cutoffs[variable] = None if cutoff == "Invalid unit" else cutoff
+    return cutoffs
+
+
+def _to_redact_intervals(df, interval_cutoffs):
     """Determines interval values that are >89 that need to be redacted
-    Returns bool because BIRTH_YEAR needs to be redacted as well based
-    on the results
+    Evaluates all interval columns of the data at once because BIRTH_YEAR
+    needs to be redacted as well based on the results
 
     Args:
-        df_col: Dataframe column/pandas.Series of an interval column
+        df: Dataframe of interval columns
+        interval_cutoffs (dict): interval variable to its cutoff
 
     Returns:
-        tuple: pandas.Series: to redact boolean vector
+        numpy.ndarray: 2-D to redact boolean mask
     """
+    cutoffs = numpy.array([interval_cutoffs[col] for col in df.columns], dtype=float)
+    # Add in errors='coerce' to turn strings into NaN
+    values = df.apply(pandas.to_numeric, errors="coerce").to_numpy(dtype=float)
+    with numpy.errstate(invalid="ignore"):
+        to_redact = values > cutoffs
     # Some centers pre-redact their values by adding >. These
     # must be redacted
-    contain_greaterthan = df_col.astype(str).str.contains(">", na=False)
-    # Add in errors='coerce' to turn strings into NaN
-    col_int = pandas.to_numeric(df_col, errors="coerce")
-    to_redact = (col_int > get_phi_cutoff(unit)) | contain_greaterthan
+    for i, col in enumerate(df.columns):
+        if not pandas.api.types.is_numeric_dtype(df[col]):
+            to_redact[:, i] |= (
+                df[col].astype(str).str.contains(">", na=False).to_numpy()
+            )
     return to_redact
 
 
@@ -160,22 +461,13 @@ def _to_redact_birth_year(df_col_birth_year, df_col_dt_compare, df_col_vital_sta
     Returns:
         tuple: pandas.core.indexes: to redact index in Dataframe
     """
-    if len(df_col_dt_compare) == 0:
-        df_col_dt_compare = datetime.date.today()
-    else:
-        df_col_dt_compare = df_col_dt_compare.fillna(
-            datetime.datetime.now().strftime("%Y-%m-%d")
-        )
-        df_col_dt_compare = df_col_dt_compare.apply(
-            lambda x: datetime.datetime.strptime(str(x), "%Y-%m-%d").date()
-        )
-    df_col_birth_year = df_col_birth_year.fillna(1900)  # arbitrary year > 89 yrs old
-    df_col_birth_date = df_col_birth_year.apply(lambda x: datetime.date(int(x), 1, 1))
-    dates_diff = df_col_dt_compare - df_col_birth_date
-    dates_phi_bool = dates_diff.map(lambda x: x.days > get_phi_cutoff("day"))
-    vital_status_bool = df_col_vital_status == "No"
-    to_redact = dates_phi_bool & vital_status_bool
-    return to_redact[to_redact].index
+    to_redact = birth_year_redaction_mask(
+        df_col_birth_year,
+        df_col_dt_compare,
+        df_col_vital_status,
+        get_phi_cutoff("day"),
+    )
+    return df_col_birth_year.index[to_redact]
 
 
 def _to_redact_seq_age(df_col_seq_age, df_col_vital_status):
@@ -196,34 +488,135 @@ def _to_redact_seq_age(df_col_seq_age, df_col_vital_status):
     return to_redact[to_redact].index
 
 
-def _redact_table(df, interval_cols_info):
-    record_to_redact = list()
-    interval_list = list(
-        set(interval_cols_info["variable"]).intersection(
-            set(df.columns.values.tolist())
+def _redact_table(df, interval_cutoffs):
+    """Redact the interval values of a table
+
+    Args:
+        df: Dataframe of a data table
+        interval_cutoffs (dict): interval variable to its cutoff
+
+    Raises:
+        ValueError: if an interval variable of the table has an invalid unit
+
+    Returns:
+        tuple: redacted Dataframe, numpy.ndarray of redacted record IDs and
+            pandas.Series of the number of redacted values per column
+    """
+    interval_list = [col for col in df.columns if col in interval_cutoffs]
+    invalid = [col for col in interval_list if interval_cutoffs[col] is None]
+    if invalid:
+        raise ValueError(f"Invalid unit for interval variables {', '.join(invalid)}")
+    if len(interval_list) == 0:
+        return df, numpy.array([], dtype=object), pandas.Series(dtype=int)
+    to_redact = _to_redact_intervals(df[interval_list], interval_cutoffs)
+    df[interval_list] = float_to_int_df(df[interval_list].mask(to_redact, ""))
+    record_to_redact = pandas.unique(df["record_id"].to_numpy()[to_redact.any(axis=1)])
+    redacted_counts = pandas.Series(to_redact.sum(axis=0), index=interval_list)
+    return df, record_to_redact, redacted_counts
+
+
+def _log_redacted_counts(redacted_counts, logger):
+    for col, count in redacted_counts[redacted_counts > 0].items():
+        logger.info("Redacted %s values of %s" % (count, col))
+
+
+def _get_full_table_data(syn, table_id, table_data=None, columns=None):
+    """Get the data of a full table from the data stored in this run, or from
+    Synapse if the table was not stored in this run
+
+    Args:
+        syn (synapseclient.Synapse): synapse client connection
+        table_id (str): Synapse ID of the full table
+        table_data (dict): table ID to the data stored in the table. Optional.
+        columns (list): columns to select. Optional, all columns by default.
+
+    Returns:
+        pandas.DataFrame: data of the table
+    """
+    if table_data is not None and table_id in table_data:
+        df = table_data[table_id]
+        return (df if columns is None else df[columns]).copy()
+    return download_synapse_table(syn, table_id, None, columns=columns)
+
+
+def _redact_and_store_table(
+    syn,
+    full_table_id,
+    redacted_table_id,
+    interval_cutoffs,
+    logger,
+    table_data=None,
+    manifest=None,
+    fingerprints=None,
+    registry=None,
+):
+    """Redact the interval values of a full table and store them in its
+    redacted table
+
+    Returns:
+        numpy.ndarray: redacted record IDs
+    """
+    if manifest is not None and manifest.is_done(redacted_table_id, "redacted"):
+        return numpy.array(manifest.get_records(redacted_table_id), dtype=object)
+    df = _get_full_table_data(syn, full_table_id, table_data)
+    with STAGE_METRICS.stage("redaction", redacted_table_id) as record:
+        record["rows"], record["columns"] = df.shape
+        new_df, new_record_to_redact, redacted_counts = _redact_table(
+            df, interval_cutoffs
         )
+    new_df.reset_index(drop=True, inplace=True)
+    if registry is None:
+        registry = TableSchemaRegistry(syn)
+    table_schema = registry.get(redacted_table_id)
+    logger.info("Updating table: %s" % table_schema.name)
+    _log_redacted_counts(redacted_counts, logger)
+    _upload_redacted_table(syn, table_schema, new_df, logger, fingerprints)
+    if manifest is not None:
+        manifest.set_done(redacted_table_id, "redacted", new_record_to_redact.tolist())
+    return new_record_to_redact
+
+
+def _upload_redacted_table(syn, table_schema, new_df, logger, fingerprints=None):
+    if fingerprints is not None and not fingerprints.has_changed(table_schema, new_df):
+        logger.info("Table is unchanged since its last snapshot, skipping upload")
+        return
+    with STAGE_METRICS.stage("upload", table_schema.id) as record:
+        record["rows"], record["columns"] = new_df.shape
+        table_query = syn.tableQuery(build_table_query(table_schema.id))
+        record["bytes"] = _update_table_rows(
+            syn, table_schema, table_query, new_df, logger
+        )
+
+
+def update_redact_table(
+    syn,
+    redacted_table_info,
+    full_data_table_info,
+    logger,
+    cache=None,
+    table_data=None,
+    workers=1,
+    manifest=None,
+    fingerprints=None,
+    registry=None,
+):
+    if registry is None:
+        registry = TableSchemaRegistry(syn)
+    interval_cols_info = download_synapse_table(
+        syn, "syn23281483", None, cache, columns=["variable", "unit"]
     )
-    if len(interval_list) != 0:
-        for col in interval_list:
-            unit = interval_cols_info.loc[
-                interval_cols_info["variable"] == col, "unit"
-            ].values[0]
-            to_redact = _to_redact_interval(df[col], unit)
-            index_to_redact = to_redact.index[to_redact == True]
-            df.loc[index_to_redact, col] = ""
-            df[col] = df[col].map(float_to_int)
-            record_to_redact = record_to_redact + [
-                df["record_id"][x] for x in index_to_redact
-            ]
-    return df, record_to_redact
-
-
-def update_redact_table(syn, redacted_table_info, full_data_table_info, logger):
-    interval_cols_info = download_synapse_table(syn, "syn23281483", "")
+    interval_cutoffs = get_interval_cutoffs(interval_cols_info)
     # Create new master table
     master_table = redacted_table_info.merge(
         full_data_table_info, on="name", suffixes=("_redacted", "_full")
     )
+    redacted_patient_id = master_table.loc[
+        master_table["name"] == "Patient Characteristics", "id_redacted"
+    ].values[0]
+    # the patient table is redacted last
+    if manifest is not None and manifest.is_done(redacted_patient_id, "redacted"):
+        logger.info("Skipping redacted tables already redacted")
+        return
     # Get the tables for checking
     curation_table_id = master_table.loc[
         master_table["name"] == "Curation and QA", "id_full"
@@ -234,16 +627,21 @@ def update_redact_table(syn, redacted_table_info, full_data_table_info, logger):
     sample_table_id = master_table.loc[
         master_table["name"] == "Cancer Panel Test", "id_full"
     ].values[0]
-    curation_info = syn.tableQuery(
-        "SELECT record_id, curation_dt FROM %s" % curation_table_id
-    ).asDataFrame()
-    patient_info = syn.tableQuery(
-        "SELECT record_id, birth_year, hybrid_death_ind FROM %s" % patient_table_id
-    ).asDataFrame()
-    sample_info = syn.tableQuery(
-        "SELECT record_id, cpt_genie_sample_id, age_at_seq_report FROM %s"
-        % sample_table_id
-    ).asDataFrame()
+    curation_info = _get_full_table_data(
+        syn, curation_table_id, table_data, ["record_id", "curation_dt"]
+    )
+    patient_info = _get_full_table_data(
+        syn,
+        patient_table_id,
+        table_data,
+        ["record_id", "birth_year", "hybrid_death_ind"],
+    )
+    sample_info = _get_full_table_data(
+        syn,
+        sample_table_id,
+        table_data,
+        ["record_id", "cpt_genie_sample_id", "age_at_seq_report"],
+    )
     patient_curation_info = patient_info.merge(
         curation_info, how="left", on="record_id"
     )
@@ -265,52 +663,80 @@ def update_redact_table(syn, redacted_table_info, full_data_table_info, logger):
         record_to_redact + clinical_info.loc[seq_age_flag, "record_id"].values.tolist()
     )
     # Check interval fields and store the data table
-    for _, row in master_table.iterrows():
-        if row["name"] != "Patient Characteristics":
-            table_id = row["id_full"]
-            df = syn.tableQuery("SELECT * FROM %s" % table_id).asDataFrame()
-            new_df, new_record_to_redact = _redact_table(df, interval_cols_info)
-            new_df.reset_index(drop=True, inplace=True)
-            record_to_redact = record_to_redact + new_record_to_redact
-            table_schema = syn.get(row["id_redacted"])
-            logger.info("Updating table: %s" % table_schema.name)
-            table_query = syn.tableQuery("SELECT * from %s" % row["id_redacted"])
-            table = syn.delete(table_query.asRowSet())  # wipe the table
-            table = syn.store(Table(table_schema, new_df))
+    tables_to_redact = master_table[master_table["name"] != "Patient Characteristics"]
+    full_table_ids = dict(
+        zip(tables_to_redact["id_redacted"], tables_to_redact["id_full"])
+    )
+    redacted_records = run_concurrently(
+        lambda table_id, table_logger: _redact_and_store_table(
+            syn,
+            full_table_ids[table_id],
+            table_id,
+            interval_cutoffs,
+            table_logger,
+            table_data,
+            manifest,
+            fingerprints,
+            registry,
+        ),
+        full_table_ids,
+        workers,
+        logger,
+        description="redacted tables",
+    )
+    for new_record_to_redact in redacted_records.values():
+        record_to_redact = record_to_redact + new_record_to_redact.tolist()
     # Modify patient table
-    df = syn.tableQuery("SELECT * FROM %s" % patient_table_id).asDataFrame()
-    new_df, new_record_to_redact = _redact_table(df, interval_cols_info)
-    new_df.reset_index(drop=True, inplace=True)
-    record_to_redact = record_to_redact + new_record_to_redact
-    # Update the patient table according to redacted records
-    logger.info("Updating patient table...")
-    final_record = list(set(record_to_redact))
-    new_df.loc[new_df["record_id"].isin(final_record), "redacted"] = "Yes"
-    new_df.loc[new_df["record_id"].isin(final_record), "birth_year"] = ""
-    new_df["birth_year"] = new_df["birth_year"].map(float_to_int)
-    new_df["redacted"] = new_df["redacted"].fillna(value="No")
-    redacted_patient_id = master_table.loc[
-        master_table["name"] == "Patient Characteristics", "id_redacted"
-    ].values[0]
-    table_schema = syn.get(redacted_patient_id)
-    table_query = syn.tableQuery("SELECT * from %s" % redacted_patient_id)
-    table = syn.delete(table_query.asRowSet())  # wipe the table
-    table = syn.store(Table(table_schema, new_df))
+    df = _get_full_table_data(syn, patient_table_id, table_data)
+    with STAGE_METRICS.stage("redaction", redacted_patient_id) as record:
+        record["rows"], record["columns"] = df.shape
+        new_df, new_record_to_redact, redacted_counts = _redact_table(
+            df, interval_cutoffs
+        )
+        new_df.reset_index(drop=True, inplace=True)
+        record_to_redact = record_to_redact + new_record_to_redact.tolist()
+        # Update the patient table according to redacted records
+        logger.info("Updating patient table...")
+        _log_redacted_counts(redacted_counts, logger)
+        final_record = list(set(record_to_redact))
+        # the stored table may hold the redaction of a previous run
+        is_redacted = new_df["record_id"].isin(final_record)
+        new_df["redacted"] = numpy.where(is_redacted, "Yes", "No")
+        new_df.loc[is_redacted, "birth_year"] = ""
+        new_df["birth_year"] = float_to_int_series(new_df["birth_year"])
+    table_schema = registry.get(redacted_patient_id)
+    _upload_redacted_table(syn, table_schema, new_df, logger, fingerprints)
     # Update redacted column in full data patient table
     logger.info("Updating redacted column in the internal table...")
     full_pt_id = master_table.loc[
         master_table["name"] == "Patient Characteristics", "id_full"
     ].values[0]
-    full_pt_schema = syn.get(full_pt_id)
-    pt_dat_query = syn.tableQuery("SELECT cohort, record_id FROM %s" % full_pt_id)
+    full_pt_schema = registry.get(full_pt_id)
+    pt_dat_query = syn.tableQuery(
+        build_table_query(full_pt_id, ["cohort", "record_id", "redacted"])
+    )
     pt_dat = pt_dat_query.asDataFrame()
     pt_dat.index = pt_dat.index.map(str)
     pt_dat["index"] = pt_dat.index
     info_to_update = new_df[["cohort", "record_id", "redacted"]]
-    result = pandas.merge(pt_dat, info_to_update, on=["cohort", "record_id"])
+    result = pandas.merge(
+        pt_dat,
+        info_to_update,
+        on=["cohort", "record_id"],
+        suffixes=("_current", ""),
+    )
+    # only the patients whose redaction changed are updated
+    result = result[result["redacted"] != result["redacted_current"]]
     result.index = result["index"]
     result = result[["redacted"]]
-    syn.store(Table(full_pt_schema, result, etag=pt_dat_query.etag))
+    if result.empty:
+        logger.info("Redacted column is unchanged")
+    else:
+        syn.store(Table(full_pt_schema, result, etag=pt_dat_query.etag))
+        if fingerprints is not None:
+            fingerprints.set_changed(full_pt_id)
+    if manifest is not None:
+        manifest.set_done(redacted_patient_id, "redacted")
 
 
 def custom_fix_for_cancer_panel_test_table(
@@ -318,6 +744,8 @@ def custom_fix_for_cancer_panel_test_table(
     master_table: pandas.DataFrame,
     logger: logging.Logger,
     config: dict,
+    cache: SynapseCache = None,
+    registry: TableSchemaRegistry = None,
 ) -> None:
     """
     This overwrites the cpt_seq_date column in the Cancer Panel Test
@@ -332,51 +760,51 @@ def custom_fix_for_cancer_panel_test_table(
         master_table (pandas.DataFrame): table of all of the primary BPC tables
         logger (logging.Logger): logger object
         config (dict): config read in
+        cache (SynapseCache): local cache of Synapse downloads. Optional.
+        registry (TableSchemaRegistry): entities of the tables. Optional.
     """
     logger.info("Custom fix in progress...")
-    # Modify the cpt_seq_date table per request
     cpt_table_id = master_table.loc[
         master_table["form_label"] == "Cancer Panel Test", "id"
     ].values[0]
-    cpt_table_schema = syn.get(cpt_table_id)
-    cpt_dat_query = syn.tableQuery("SELECT cpt_genie_sample_id FROM %s" % cpt_table_id)
+    if registry is None:
+        registry = TableSchemaRegistry(syn)
+    cpt_table_schema = registry.get(cpt_table_id)
+    cpt_dat_query = syn.tableQuery(
+        build_table_query(cpt_table_id, ["cpt_genie_sample_id", "cpt_sample_type"])
+    )
     cpt_dat = cpt_dat_query.asDataFrame()
     cpt_dat.index = cpt_dat.index.map(str)
-    cpt_dat["index"] = cpt_dat.index
+    # Modify the cpt_seq_date table per request
     genie_sample_dat = get_main_genie_clinical_sample_file(
         syn,
         release=config["main_genie_release_version"],
         release_files_table_synid=config["main_genie_data_release_files"],
         logger=logger,
+        cache=cache,
+    )
+    seq_year = genie_sample_dat.drop_duplicates("SAMPLE_ID").set_index("SAMPLE_ID")[
+        "SEQ_YEAR"
+    ]
+    cpt_dat["cpt_seq_date"] = float_to_int_series(
+        cpt_dat["cpt_genie_sample_id"].map(seq_year)
     )
-    cpt_seq_dat = cpt_dat.merge(
-        genie_sample_dat,
-        how="left",
-        left_on="cpt_genie_sample_id",
-        right_on="SAMPLE_ID",
-    )
-    cpt_seq_dat.index = cpt_seq_dat["index"]
-    cpt_seq_dat = cpt_seq_dat[["SEQ_YEAR"]]
-    cpt_seq_dat.columns = ["cpt_seq_date"]
-    cpt_seq_dat["cpt_seq_date"] = cpt_seq_dat["cpt_seq_date"].map(float_to_int)
-    syn.store(Table(cpt_table_schema, cpt_seq_dat, etag=cpt_dat_query.etag))
     # Modify the cpt_sample_type -> map to text value
-    cpt_table_schema = syn.get(cpt_table_id)
-    cpt_dat_query = syn.tableQuery(
-        "SELECT cpt_sample_type FROM %s WHERE cpt_sample_type in (1,2,3,4,5,6,7)"
-        % cpt_table_id
+    sample_type_mapping = download_synapse_table(
+        syn,
+        config["main_genie_sample_mapping_table"],
+        None,
+        cache,
+        columns=["CODE", "DESCRIPTION"],
     )
-    cpt_dat = cpt_dat_query.asDataFrame()
-    cpt_dat["cpt_sample_type"] = pandas.to_numeric(cpt_dat["cpt_sample_type"])
-    sample_type_mapping = syn.tableQuery(
-        f"SELECT * FROM {config['main_genie_sample_mapping_table']}"
-    ).asDataFrame()
-    sample_type_mapping_dict = sample_type_mapping.set_index("CODE").to_dict()[
-        "DESCRIPTION"
-    ]
-    cpt_dat["cpt_sample_type"] = cpt_dat["cpt_sample_type"].map(
-        sample_type_mapping_dict
+    sample_type_mapping = sample_type_mapping.set_index("CODE")["DESCRIPTION"]
+    sample_type_code = pandas.to_numeric(cpt_dat["cpt_sample_type"], errors="coerce")
+    is_code = sample_type_code.isin([1, 2, 3, 4, 5, 6, 7])
+    cpt_dat["cpt_sample_type"] = cpt_dat["cpt_sample_type"].where(
+        ~is_code, sample_type_code.map(sample_type_mapping)
     )
+    # Store both columns in one transaction
+    cpt_dat = cpt_dat[["cpt_seq_date", "cpt_sample_type"]]
     syn.store(Table(cpt_table_schema, cpt_dat, etag=cpt_dat_query.etag))
     logger.info(f"SAMPLE_MAPPING_TYPE:{config['main_genie_sample_mapping_table']}")
     logger.info("Completed")
@@ -401,6 +829,63 @@ def main():
     )
     parser.add_argument("-m", "--message", default="", help="Version comment")
     parser.add_argument("-d", "--dry_run", action="store_true", help="dry run flag")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of tables updated or redacted concurrently",
+    )
+    parser.add_argument(
+        "-r",
+        "--record_index",
+        default=None,
+        help="File to keep the record IDs of the irr tables between runs",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=None,
+        help="Read the cohort files in chunks of this many rows into Parquet form "
+        "files to limit memory",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        help="Directory to cache Synapse downloads between runs",
+    )
+    parser.add_argument(
+        "--parquet_input",
+        default=None,
+        help="Directory of label data written with --parquet_output to use "
+        "instead of the cohort files",
+    )
+    parser.add_argument(
+        "--parquet_output",
+        default=None,
+        help="Directory to write the label data to as Parquet files",
+    )
+    parser.add_argument(
+        "--output_format",
+        default="csv",
+        choices=["csv", "parquet"],
+        help="Format of the table files written in a dry run",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the tables completed by the failed run in the manifest",
+    )
+    parser.add_argument(
+        "--manifest",
+        default="run_manifest.json",
+        help="File to keep the completed phases of every table of the run",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only reload the cohorts whose file changed since it was loaded",
+    )
 
     args = parser.parse_args()
     table_type = args.table
@@ -408,6 +893,12 @@ def main():
     project_config = args.project_config
     comment = args.message
     dry_run = args.dry_run
+    workers = args.workers
+    chunksize = args.chunksize
+    cache = SynapseCache(args.cache_dir) if args.cache_dir else None
+    record_index_path = args.record_index
+    if record_index_path is None and args.cache_dir:
+        record_index_path = os.path.join(args.cache_dir, "record_index.json")
 
     # login to synapse
     syn = synapse_login(synapse_config)
@@ -416,6 +907,8 @@ def main():
     logger_name = "testing" if dry_run else "production"
     logger = setup_custom_logger(logger_name)
     logger.info("Updating data tables on Synapse!")
+    # write the stage metrics next to the log, also if the run fails
+    atexit.register(STAGE_METRICS.write, "metrics")
 
     # read the project config file
     with open(project_config) as config_file:
@@ -425,7 +918,9 @@ def main():
     # get master table
     # This is the internal tables with non redacted
     table_id, condition = list(TABLE_INFO[table_type])
-    master_table = download_synapse_table(syn, table_id, condition)
+    master_table = download_synapse_table(
+        syn, table_id, condition, cache, columns=["id", "name", "form_label"]
+    )
     # This contains external tables with redacted
     TABLE_INFO["redacted"] = (
         "syn21446696",
@@ -433,32 +928,159 @@ def main():
     )
 
     # download data files
-    # TODO: find the cohort that has new data
     # This is a mapping to all the intake data. e.g: ProstateBPCIntake_data
     # found here: https://www.synapse.org/Synapse:syn23286928
     cohort_info_selected = config[table_type]
-    cohort_data_list = []
-    for cohort in cohort_info_selected:
-        df = get_data(syn, cohort_info_selected[cohort], cohort)
-        cohort_data_list.append(df)
-    label_data = pandas.concat(cohort_data_list, axis=0, ignore_index=True)
-    label_data["redacted"] = numpy.nan
-
-    # update data tables
-    store_data(syn, master_table, label_data, table_type, logger, dry_run)
+    data_element_catalog = download_synapse_table(
+        syn,
+        DATA_ELEMENT_CATALOG_ID,
+        {"dataType": "curated"},
+        cache,
+        columns=["variable", "type", "synColType", "colLabels"],
+    )
+    dtypes = get_catalog_dtypes(data_element_catalog)
+    if args.parquet_input:
+        # the label data may have been read from older versions of the files
+        input_versions = get_label_data_versions(args.parquet_input)
+    else:
+        input_versions = get_input_versions(syn, cohort_info_selected)
+    registry = TableSchemaRegistry(syn)
+    registry.prefetch(master_table["id"], logger)
+    # a dry run does not complete any phase, so it is not recorded
+    manifest = None
     if not dry_run:
-        custom_fix_for_cancer_panel_test_table(syn, master_table, logger, config)
+        manifest = RunManifest(args.manifest)
+        manifest.start({"table_type": table_type, "files": input_versions}, args.resume)
+    cohorts = None
+    if args.incremental:
+        cohorts = get_changed_cohorts(registry, master_table["id"], input_versions)
+        if not cohorts and not args.resume:
+            logger.info("No cohort has new data, the tables are up to date")
+            return
+        logger.info("Cohorts with new data: %s" % ", ".join(cohorts))
+        cohort_info_selected = {
+            cohort: cohort_info_selected[cohort] for cohort in cohorts
+        }
+    # versions of the files the label data is read from
+    label_versions = {
+        cohort: version
+        for cohort, version in input_versions.items()
+        if cohort in cohort_info_selected
+    }
+    if manifest is not None and all(
+        manifest.is_done(table_id, "stored") for table_id in master_table["id"]
+    ):
+        logger.info("Skipping the label data, all tables are already stored")
+        label_data = None
+    elif cohorts == []:
+        logger.info("Skipping the label data, no cohort has new data")
+        label_data = None
+    elif args.parquet_input:
+        label_data = ParquetLabelData(args.parquet_input)
+    elif chunksize:
+        # the forms are written straight to the Parquet output, or else to a
+        # temporary directory
+        stream_path = args.parquet_output
+        if stream_path is None:
+            stream_path = tempfile.mkdtemp(prefix="label_data_")
+            atexit.register(shutil.rmtree, stream_path, ignore_errors=True)
+        label_data = stream_label_data(
+            syn, cohort_info_selected, chunksize, stream_path, dtypes, label_versions
+        )
+    else:
+        label_data = get_cohort_data(
+            syn, cohort_info_selected, logger, dtypes, cache, workers
+        )
+        with STAGE_METRICS.stage("partition") as record:
+            record["rows"], record["columns"] = label_data.shape
+            label_data = partition_label_data(label_data)
+    fingerprints = TableFingerprints()
+    if label_data is None:
+        table_data = {}
+    else:
+        if args.parquet_output and (args.parquet_input or not chunksize):
+            write_label_data_parquet(label_data, args.parquet_output, label_versions)
+        label_data.add_column("redacted")
+
+        # update data tables
+        record_index = RecordIdIndex(record_index_path)
+        table_data = store_data(
+            syn,
+            master_table,
+            label_data,
+            table_type,
+            logger,
+            dry_run,
+            workers,
+            record_index,
+            args.output_format,
+            manifest,
+            fingerprints,
+            cohorts,
+            registry,
+        )
+        record_index.save()
+        if cohorts is not None:
+            # the stored data only has the rows of the reloaded cohorts
+            table_data = {}
+    if not dry_run:
+        cpt_table_id = master_table.loc[
+            master_table["form_label"] == "Cancer Panel Test", "id"
+        ].values[0]
+        if not manifest.is_done(cpt_table_id, "fixed"):
+            custom_fix_for_cancer_panel_test_table(
+                syn, master_table, logger, config, cache, registry
+            )
+            manifest.set_done(cpt_table_id, "fixed")
+        fingerprints.set_changed(cpt_table_id)
+        # the custom fix changed the Cancer Panel Test table after it was stored
+        table_data.pop(cpt_table_id, None)
         if table_type == "primary":
             table_id, condition = list(TABLE_INFO["redacted"])
-            redacted_table_info = download_synapse_table(syn, table_id, condition)
+            redacted_table_info = download_synapse_table(
+                syn, table_id, condition, cache, columns=["id", "name"]
+            )
+            registry.prefetch(redacted_table_info["id"], logger)
             logger.info("Updating redacted tables...")
-            update_redact_table(syn, redacted_table_info, master_table, logger)
+            update_redact_table(
+                syn,
+                redacted_table_info,
+                master_table,
+                logger,
+                cache,
+                table_data,
+                workers,
+                manifest,
+                fingerprints,
+                registry,
+            )
             logger.info("Updating version for redacted tables")
-            for table_id in redacted_table_info["id"]:
-                update_version(syn, table_id, comment)
+            snapshot_tables(
+                syn,
+                redacted_table_info["id"],
+                comment,
+                logger,
+                manifest=manifest,
+                fingerprints=fingerprints,
+            )
         logger.info("Updating version for %s tables" % table_type)
-        for table_id in master_table["id"]:
-            update_version(syn, table_id, comment)
+        # the loaded versions are only annotated once a table is up to date,
+        # so an incremental rerun reloads the cohorts of a failed run
+        snapshot_tables(
+            syn,
+            master_table["id"],
+            comment,
+            logger,
+            manifest=manifest,
+            fingerprints=fingerprints,
+            input_versions=input_versions,
+            partial=cohorts is not None,
+        )
+        if fingerprints.skipped:
+            logger.info(
+                "Skipped upload and snapshot of %s unchanged tables: %s"
+                % (len(fingerprints.skipped), ", ".join(sorted(fingerprints.skipped)))
+            )
         logger.info("Table update is completed!")
 
 
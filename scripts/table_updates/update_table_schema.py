@@ -10,12 +10,14 @@ TABLE_INFO = {"sage": ('syn23285911',"table_type='data'"),
               "bpc": ('syn21446696',"table_type='data' and double_curated is false"),
               "irr": ('syn21446696',"table_type='data' and double_curated is true")}
 
-def copy_table_schema(syn, from_table_id, to_table_id):
+def copy_table_schema(syn, from_table_id, to_table_id, registry=None):
     """
     Copy table schema from one table to another
     """
-    from_table_schema = syn.get(from_table_id)
-    to_table_schema = syn.get(to_table_id)
+    if registry is None:
+        registry = TableSchemaRegistry(syn)
+    from_table_schema = registry.get(from_table_id)
+    to_table_schema = registry.get(to_table_id)
     to_table_schema.columnIds = from_table_schema.columnIds
     return to_table_schema
 
@@ -44,7 +46,9 @@ def _expand_checkbox_vars(row):
             temp_df_list.append(temp_df)
         return pandas.DataFrame(temp_df_list)
 
-def _update_table_schema(syn, form, curated_data_element, logger, dry_run):
+def _update_table_schema(syn, form, curated_data_element, logger, dry_run, registry=None):
+    if registry is None:
+        registry = TableSchemaRegistry(syn)
     form_name = form[0]
     form_df = form[1]
     form_name_list = form_name.split(', ')
@@ -54,8 +58,7 @@ def _update_table_schema(syn, form, curated_data_element, logger, dry_run):
     # get the data frame of existing columns
     current_cols_df = pandas.DataFrame()
     for _, row in form_df.iterrows():
-        current_cols = syn.getColumns(row['id'])
-        current_cols = pandas.DataFrame(current_cols)
+        current_cols = pandas.DataFrame(registry.get_columns(row['id']))
         current_cols['table_id'] = row['id']
         current_cols_df = pandas.concat([current_cols_df, current_cols])
     # get the table id with the least columns
@@ -75,7 +78,8 @@ def _update_table_schema(syn, form, curated_data_element, logger, dry_run):
     # columns to add
     cols_to_add = []
     #  non-checkbox 
-    non_check_to_add = list(set(non_check_vars['variable'])-set(non_check_cols['name']))
+    current_col_names = set().union(*[registry.get_column_name_set(table_id) for table_id in form_df['id']])
+    non_check_to_add = list(set(non_check_vars['variable'])-current_col_names)
     if len(non_check_to_add) != 0:
         non_check_to_add_df = non_check_vars[non_check_vars.variable.isin(non_check_to_add)]
         non_check_new_cols = list(non_check_to_add_df.apply(lambda x: create_synapse_column(x['variable'],x['synColType'],x['synColSize']),axis=1))
@@ -129,48 +133,52 @@ def _update_table_schema(syn, form, curated_data_element, logger, dry_run):
             #cols_to_add = syn.createColumns(cols_to_add)
             cols_to_add = [syn.store(i) for i in cols_to_add]
             if tbl_with_least_cols_ct+len(cols_to_add) <= 152:
-                tbl_schema = syn.get(tbl_with_least_cols_id)
+                tbl_schema = registry.get(tbl_with_least_cols_id)
                 cols_to_add_id = [col['id'] for col in cols_to_add]
                 tbl_schema.columnIds = tbl_schema.columnIds+cols_to_add_id
                 tbl_schema = syn.store(tbl_schema)
+                registry.update(tbl_schema)
             else:
                 logger.info('TODO: need to add a new table')
         if len(cols_to_update) != 0:
             for table_id in cols_to_update.keys():
-                tbl_schema = syn.get(table_id)
+                tbl_schema = registry.get(table_id)
                 tbl_schema.columnIds = [ele for ele in tbl_schema.columnIds if ele not in cols_to_update[table_id]['old']]
                 cols_to_update_new = [syn.store(i) for i in cols_to_update[table_id]['new']]
                 cols_to_update_new_id = [col['id'] for col in cols_to_update_new]
                 tbl_schema.columnIds = tbl_schema.columnIds+cols_to_update_new_id
                 tbl_schema = syn.store(tbl_schema)
+                registry.update(tbl_schema)
 
-def update_table_schema(syn, logger, dry_run):
+def update_table_schema(syn, logger, dry_run, cache=None, workers=8):
     # get the data elements
-    curated_data_element = download_synapse_table(syn,"syn21431364","dataType='curated'")
-    curated_data_element = curated_data_element[['variable','instrument','type','synColType','synColSize','numCols','colLabels']]
+    curated_data_element = download_synapse_table(syn,"syn21431364",{'dataType':'curated'},cache,
+                                                  columns=['variable','instrument','type','synColType','synColSize','numCols','colLabels'])
     # create the master table 
-    sage_table_view = download_synapse_table(syn,TABLE_INFO['sage'][0],TABLE_INFO['sage'][1])
+    sage_table_view = download_synapse_table(syn,TABLE_INFO['sage'][0],TABLE_INFO['sage'][1],cache)
     sage_table_view.drop(columns='table_type',axis=1,inplace=True)
-    bpc_table_view = download_synapse_table(syn,TABLE_INFO['bpc'][0],TABLE_INFO['bpc'][1])
-    bpc_table_view = bpc_table_view[['id','name']]
-    irr_table_view = download_synapse_table(syn,TABLE_INFO['irr'][0],TABLE_INFO['irr'][1])
-    irr_table_view = irr_table_view[['id','name']]
+    bpc_table_view = download_synapse_table(syn,TABLE_INFO['bpc'][0],TABLE_INFO['bpc'][1],cache,columns=['id','name'])
+    irr_table_view = download_synapse_table(syn,TABLE_INFO['irr'][0],TABLE_INFO['irr'][1],cache,columns=['id','name'])
     irr_table_view['name'] = irr_table_view['name'].apply(lambda x: x.replace(' - double curated',''))
     master_table_view = pandas.merge(sage_table_view, 
                                      pandas.merge(bpc_table_view,irr_table_view,
                                                   on='name',suffixes=['_bpc','_irr']),
                                      on='name')
+    # fetch the schemas and columns of all tables at once
+    registry = TableSchemaRegistry(syn)
+    registry.prefetch(list(master_table_view['id'])+list(master_table_view['id_bpc'])+list(master_table_view['id_irr']),
+                      logger, workers)
     # update table schema for Sage Internal tables
     form_groups = master_table_view.groupby('form')
     for form in form_groups:
-        _update_table_schema(syn, form, curated_data_element, logger, dry_run)
+        _update_table_schema(syn, form, curated_data_element, logger, dry_run, registry)
     # copy the table schema to update the BPC Internal and IRR tables
     if not dry_run:
         logger.info("Updating table schemas for BPC and IRR tables")
         for _, row in master_table_view.iterrows():
-            new_bpc_schema = copy_table_schema(syn,row['id'],row['id_bpc'])
+            new_bpc_schema = copy_table_schema(syn,row['id'],row['id_bpc'],registry)
             syn.store(new_bpc_schema)
-            new_irr_schema = copy_table_schema(syn,row['id'],row['id_irr'])
+            new_irr_schema = copy_table_schema(syn,row['id'],row['id_irr'],registry)
             syn.store(new_irr_schema)
 
 def main():
@@ -185,6 +193,17 @@ def main():
         action="store_true",
         help="dry run flag"
     )
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        help="Directory to cache Synapse downloads between runs"
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=8,
+        help="Number of table schemas fetched concurrently"
+    )
 
     args = parser.parse_args()
     dry_run = args.dry_run
@@ -196,7 +215,8 @@ def main():
     logger = setup_custom_logger(logger_name)
     logger.info('Updating BPC Synapse Table schemas!')
 
-    update_table_schema(syn,logger,dry_run)
+    cache = SynapseCache(args.cache_dir) if args.cache_dir else None
+    update_table_schema(syn,logger,dry_run,cache,args.workers)
 
 if __name__ == "__main__":
     main()
@@ -1,10 +1,26 @@
+import datetime
+import contextlib
+import hashlib
+import json
 import logging
+import os
+import resource
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
 
+import numpy
 import pandas
 import synapseclient
 from synapseclient import Schema, Column, Table
 
+NA_VALUES = ["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "n/a", "nan", "null"]
+
+# REDCap variable types with a fixed set of choices
+CHOICE_TYPES = ["dropdown", "radio", "checkbox", "yesno"]
+
 def _is_float(val):
     """Check if the value is float
 
@@ -35,45 +51,1141 @@ def float_to_int(val):
             return str(int(val))
     return val
 
+def float_to_int_series(col):
+    """Vectorized float_to_int for a single column
+
+    Integral floats and integers are rewritten to their integer string form
+    for the whole column at once. Object columns are normalized through
+    their unique values so text columns are only touched when one of their
+    values actually changes. The result matches
+    ``col.map(float_to_int)`` value for value, except that integers above
+    2**53 keep all their digits instead of being rounded through a float,
+    and None is kept as a missing value where float_to_int raises TypeError.
+
+    Args:
+        col (pandas.Series): column to be reformatted
+
+    Returns:
+        pandas.Series: reformatted column
+    """
+    if col.empty:
+        return col
+    values = col.values
+    if isinstance(col.dtype, pandas.api.extensions.ExtensionDtype) and col.dtype.kind in "iub":
+        # nullable integers from the catalog dtypes, NA stays NaN
+        result = numpy.full(len(col), numpy.nan, dtype=object)
+        valid = col.notnull().values
+        result[valid] = col[valid].astype(numpy.int64).astype(str).values
+        return pandas.Series(result, index=col.index, name=col.name)
+    if values.dtype.kind == "f":
+        finite = numpy.isfinite(values)
+        integral = finite.copy()
+        integral[finite] = numpy.mod(values[finite], 1) == 0
+        if not integral.any():
+            return col
+        # values outside of the int64 range need python integers
+        if numpy.abs(values[integral]).max() >= 2**63:
+            return col.map(float_to_int)
+        result = values.astype(object)
+        result[integral] = values[integral].astype(numpy.int64).astype(str)
+        return pandas.Series(result, index=col.index, name=col.name).infer_objects()
+    if values.dtype.kind in "iub":
+        if values.dtype.kind == "b":
+            values = values.astype(numpy.int64)
+        result = values.astype(str).astype(object)
+        return pandas.Series(result, index=col.index, name=col.name)
+    values = col.astype(object).values
+    codes, uniques = pandas.factorize(values)
+    uniques = numpy.asarray(uniques, dtype=object)
+    converted = numpy.empty(len(uniques), dtype=object)
+    converted[:] = [float_to_int(val) for val in uniques]
+    if all(new is old for new, old in zip(converted, uniques)):
+        result = values
+    else:
+        result = converted.take(codes)
+        result[codes == -1] = values[codes == -1]
+    return pandas.Series(result, index=col.index, name=col.name).infer_objects()
+
+def float_to_int_df(df):
+    """Vectorized float_to_int for every column of a data frame
+
+    Args:
+        df (pandas.DataFrame): data to be reformatted
+
+    Returns:
+        pandas.DataFrame: reformatted data, equal to
+        ``df.applymap(float_to_int)`` except as noted in float_to_int_series
+    """
+    return pandas.DataFrame(
+        {i: float_to_int_series(df.iloc[:, i]) for i in range(df.shape[1])},
+        index=df.index,
+    ).set_axis(df.columns, axis=1)
+
 def check_empty_row(row, cols_to_skip):
     """
     Check if the row of data is empty with given columns to skip
     """
     return row.drop(cols_to_skip).isnull().all()
 
-def download_synapse_table(syn, table_id, condition):
+def check_empty_rows(df, cols_to_skip):
+    """Check which rows of data are empty with given columns to skip
+
+    Vectorized version of check_empty_row for a whole data frame.
+
+    Args:
+        df (pandas.DataFrame): data to be checked
+        cols_to_skip (list): columns ignored in the check
+
+    Returns:
+        pandas.Series: boolean mask of the empty rows
+    """
+    return df.drop(columns=cols_to_skip).isnull().all(axis=1)
+
+def birth_year_redaction_mask(birth_year, date_compare, vital_status, cutoff_days):
+    """Determine which patients are alive and older than the cutoff as of the date to compare
+
+    The dates are compared as numpy datetime64 arrays. A missing birth year is
+    taken as 1900 and a missing date to compare as today.
+
+    Args:
+        birth_year (pandas.Series): birth years
+        date_compare (pandas.Series): dates to compare in %Y-%m-%d format
+        vital_status (pandas.Series): "Yes" if deceased, "No" if alive
+        cutoff_days (int): largest age in days that is not redacted
+
+    Returns:
+        numpy.ndarray: boolean mask of the patients to redact
+    """
+    today = numpy.datetime64(datetime.date.today(), "D")
+    if len(date_compare) == 0:
+        date_compare = numpy.full(len(birth_year), today)
+    else:
+        date_compare = pandas.to_datetime(numpy.asarray(date_compare), format="%Y-%m-%d")
+        date_compare = date_compare.values.astype("datetime64[D]")
+        date_compare[numpy.isnat(date_compare)] = today
+    birth_year = pandas.to_numeric(pandas.Series(birth_year)).astype(float).fillna(1900)  # arbitrary year > 89 yrs old
+    birth_date = (birth_year.to_numpy().astype("int64") - 1970).astype("datetime64[Y]").astype("datetime64[D]")
+    age_days = (date_compare - birth_date).astype("int64")
+    return((age_days > cutoff_days) & (pandas.Series(vital_status) == "No").to_numpy())
+
+def _normalize_for_hash(df):
+    """Normalize data to strings so local and Synapse values compare equal"""
+    df = float_to_int_df(df).astype(object)
+    return df.where(df.notnull(), "").astype(str)
+
+def get_row_hashes(df):
+    """Hash the content of every row of the data
+
+    Args:
+        df (pandas.DataFrame): data to be hashed
+
+    Returns:
+        pandas.Series: hash of each row
+    """
+    return pandas.util.hash_pandas_object(_normalize_for_hash(df), index=False)
+
+def _get_row_keys(df, key_columns):
+    """Join the key columns of every row into one string"""
+    keys = _normalize_for_hash(df[key_columns])
+    return reduce(lambda x, y: x + "\x1f" + y, [keys[col] for col in key_columns])
+
+def diff_table_rows(existing, new, key_columns, kept_columns=None):
+    """Compare the rows of a Synapse table with the new data by key
+
+    Args:
+        existing (pandas.DataFrame): table data indexed by ROW_ID_VERSION
+        new (pandas.DataFrame): new data of the table
+        key_columns (list): columns identifying a row
+        kept_columns (list): columns whose existing values are kept in the
+            rows found in the table. Optional.
+
+    Returns:
+        tuple: new rows to insert, changed rows to update indexed by the
+        ROW_ID_VERSION of the existing row and existing rows to delete.
+        None if the rows can not be matched by key.
+    """
+    if not set(key_columns) <= set(new.columns) & set(existing.columns):
+        return None
+    new = new.reindex(columns=existing.columns)
+    new_keys = _get_row_keys(new, key_columns)
+    existing_keys = _get_row_keys(existing, key_columns)
+    if new_keys.duplicated().any() or existing_keys.duplicated().any():
+        return None
+    to_insert = new[~new_keys.isin(existing_keys)]
+    to_delete = existing[~existing_keys.isin(new_keys)]
+    in_table = new_keys.isin(existing_keys)
+    matched = new[in_table]
+    matched_index = pandas.Series(existing.index, index=existing_keys.values)[
+        new_keys[in_table].values
+    ]
+    if kept_columns:
+        matched = matched.copy()
+        matched[kept_columns] = existing.loc[matched_index.values, kept_columns].values
+    changed = (
+        get_row_hashes(matched).values
+        != get_row_hashes(existing.loc[matched_index.values]).values
+    )
+    to_update = matched[changed]
+    to_update.index = matched_index.values[changed]
+    return to_insert, to_update, to_delete
+
+# annotation of a table with the fingerprint of its last snapshot
+FINGERPRINT_ANNOTATION = "contentFingerprint"
+
+def get_table_fingerprint(df):
+    """Hash the content of a table, independent of the order of its rows and columns
+
+    Args:
+        df (pandas.DataFrame): data of the table
+
+    Returns:
+        String: SHA-256 hex digest of the content
+    """
+    df = df[sorted(df.columns)]
+    fingerprint = hashlib.sha256("\x1f".join(df.columns).encode())
+    fingerprint.update(numpy.sort(get_row_hashes(df).to_numpy()).tobytes())
+    return(fingerprint.hexdigest())
+
+class TableFingerprints:
+    """Content fingerprints of the tables updated in a run
+
+    The fingerprint of the data sent to a table is compared with the one
+    annotated on the table at its last snapshot. Unchanged tables are
+    neither uploaded nor snapshotted, and the fingerprint is annotated on
+    the tables once they are snapshotted.
+    """
+
+    def __init__(self):
+        self.fingerprints = {}
+        self.skipped = set()
+        self._lock = threading.Lock()
+
+    def has_changed(self, table_schema, df):
+        """Check if the data of a table differs from its last snapshot
+
+        Args:
+            table_schema (synapseclient.Schema): schema of the table
+            df (pandas.DataFrame): data to be sent to the table
+
+        Returns:
+            boolean: False if the table is unchanged and is skipped
+        """
+        fingerprint = get_table_fingerprint(df)
+        last_fingerprint = table_schema.get(FINGERPRINT_ANNOTATION, [None])
+        if isinstance(last_fingerprint, list):
+            last_fingerprint = last_fingerprint[0] if last_fingerprint else None
+        with self._lock:
+            self.fingerprints[table_schema.id] = fingerprint
+            if fingerprint == last_fingerprint:
+                self.skipped.add(table_schema.id)
+                return False
+            self.skipped.discard(table_schema.id)
+            return True
+
+    def set_changed(self, table_id):
+        """Mark a table as changed after its data was modified in other ways"""
+        with self._lock:
+            self.skipped.discard(table_id)
+
+    def is_skipped(self, table_id):
+        with self._lock:
+            return table_id in self.skipped
+
+    def save(self, syn, table_id):
+        """Annotate a table with the fingerprint of its data
+
+        Args:
+            syn: Synapse credential
+            table_id (String): Synapse ID of the table
+        """
+        with self._lock:
+            fingerprint = self.fingerprints.get(table_id)
+        if fingerprint is None:
+            return
+        annotations = syn.get_annotations(table_id)
+        annotations[FINGERPRINT_ANNOTATION] = fingerprint
+        syn.set_annotations(annotations)
+
+class SynapseCache:
+    """Local cache of Synapse file downloads and table query results
+
+    Files are keyed by (Synapse ID, version) and query results by
+    (query, table etag), so an entry is never stale. Entries are stored as
+    Parquet and the least recently used ones are evicted once the cache
+    grows over its maximum size.
+
+    Args:
+        cache_dir (String): directory of the cache
+        max_size (int): maximum size of the cache in bytes
+    """
+
+    def __init__(self, cache_dir, max_size=20 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._index_path = os.path.join(cache_dir, "index.json")
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.entries = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path) as index_file:
+                self.entries = json.load(index_file)
+
+    def _get_path(self, key):
+        digest = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest + ".parquet")
+
+    def get(self, key):
+        """Get a cached data frame
+
+        Args:
+            key (list): key of the entry
+
+        Returns:
+            Dataframe: cached data, None if not in the cache
+        """
+        path = self._get_path(key)
+        with self._lock:
+            entry = self.entries.get(path)
+            if entry is None or not os.path.exists(path):
+                return None
+            entry["last_used"] = time.time()
+            self._write_index()
+        return pandas.read_parquet(path)
+
+    def put(self, key, df):
+        """Add a data frame to the cache
+
+        Data that can not be stored as Parquet, e.g. columns mixing
+        numbers and text, is not cached.
+
+        Args:
+            key (list): key of the entry
+            df (Dataframe): data to cache
+        """
+        path = self._get_path(key)
+        try:
+            df.to_parquet(path)
+        except Exception:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        with self._lock:
+            self.entries[path] = {"size": os.path.getsize(path), "last_used": time.time()}
+            self._evict()
+            self._write_index()
+
+    def _evict(self):
+        total_size = sum(entry["size"] for entry in self.entries.values())
+        for path in sorted(self.entries, key=lambda x: self.entries[x]["last_used"]):
+            if total_size <= self.max_size:
+                break
+            total_size -= self.entries.pop(path)["size"]
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _write_index(self):
+        with open(self._index_path, "w") as index_file:
+            json.dump(self.entries, index_file)
+
+def cached_table_query(syn, query, table_id, cache=None):
+    """Query a Synapse Table, reusing a cached result if the table is unchanged
+
+    Args:
+        syn: Synapse credential
+        query (String): query of the table
+        table_id (String): Synapse ID of the queried table
+        cache (SynapseCache): local cache. Optional.
+
+    Returns:
+        Dataframe: query result
+    """
+    if cache is None:
+        return syn.tableQuery(query).asDataFrame()
+    key = ["query", query, get_table_etag(syn, table_id)]
+    synapse_table = cache.get(key)
+    if synapse_table is None:
+        synapse_table = syn.tableQuery(query).asDataFrame()
+        cache.put(key, synapse_table)
+    return synapse_table
+
+def cached_read_file(syn, synapse_id, read_file, cache=None, follow_link=False):
+    """Download and read a Synapse file, reusing a cached read of the same version
+
+    Args:
+        syn: Synapse credential
+        synapse_id (String): Synapse ID of a file
+        read_file: function reading the downloaded file path into a data frame
+        cache (SynapseCache): local cache. Optional.
+        follow_link (bool): whether the Synapse ID is a link to the file
+
+    Returns:
+        Dataframe: content of the file
+    """
+    link_args = {"followLink": True} if follow_link else {}
+    if cache is None:
+        return _download_and_read(lambda: syn.get(synapse_id, **link_args), synapse_id, read_file)
+    entity = syn.get(synapse_id, downloadFile=False, **link_args)
+    key = ["file", entity.id, entity.versionNumber]
+    df = cache.get(key)
+    if df is None:
+        df = _download_and_read(lambda: syn.get(entity.id, version=entity.versionNumber), synapse_id, read_file)
+        cache.put(key, df)
+    return df
+
+def _download_and_read(download, synapse_id, read_file):
+    """Download a file and read it, recording both stages in STAGE_METRICS"""
+    with STAGE_METRICS.stage("download", synapse_id) as record:
+        path = download().path
+        record["bytes"] = _file_size(path)
+    with STAGE_METRICS.stage("parse", synapse_id) as record:
+        df = read_file(path)
+        record["rows"], record["columns"] = df.shape
+    return df
+
+def _file_size(path):
+    try:
+        return(os.path.getsize(path))
+    except (OSError, TypeError):
+        return(None)
+
+def _format_sql_value(value):
+    """Format a value as a Synapse SQL literal"""
+    if isinstance(value, (list, tuple, set)):
+        return("(%s)" % ", ".join(_format_sql_value(val) for val in value))
+    if isinstance(value, (bool, numpy.bool_)):
+        return("true" if value else "false")
+    if isinstance(value, (int, float, numpy.number)):
+        return(str(value))
+    return("'%s'" % str(value).replace("'", "''"))
+
+def build_table_query(table_id, columns=None, condition=None):
+    """Build a Synapse table query that only selects the given columns and rows
+
+    Args:
+        table_id: Synapse ID of a table
+        columns (list): columns to select. Optional, all columns by default.
+        condition: condition for querying the table, either as SQL or as a
+            dict of column to value. A column matches any value of a list.
+            Optional.
+
+    Returns:
+        String: Synapse table query
+    """
+    query = "SELECT %s FROM %s" % (", ".join(columns) if columns else "*", table_id)
+    if isinstance(condition, dict):
+        condition = " AND ".join(
+            "%s %s %s" % (col, "IN" if isinstance(value, (list, tuple, set)) else "=", _format_sql_value(value))
+            for col, value in condition.items())
+    if condition:
+        query += " WHERE " + condition
+    return(query)
+
+def download_synapse_table(syn, table_id, condition, cache=None, columns=None):
     """Download Synapse Table with the given table ID and condition
     
     Args:
         syn: Synapse credential
         table_id: Synapse ID of a table
-        condition: additional condition for querying the table
+        condition: additional condition for querying the table, either as
+            SQL or as a dict of column to value
+        cache (SynapseCache): local cache. Optional.
+        columns (list): columns to select. Optional, all columns by default.
     
     Returns:
         Dataframe: synapse table
     """
-    if condition:
-        condition = " WHERE "+condition
-    synapse_table = syn.tableQuery("SELECT * from %s%s" % (table_id,condition))
-    synapse_table = synapse_table.asDataFrame()
+    synapse_table = cached_table_query(syn, build_table_query(table_id, columns, condition), table_id, cache)
     return(synapse_table)
 
-def get_data(syn, label_data_id, cohort):
-    """Download csv file from Synapse and add cohort column
+def get_table_etag(syn, table_id):
+    """Get the current etag of a Synapse Table without downloading its rows
+
+    Args:
+        syn: Synapse credential
+        table_id: Synapse ID of a table
+
+    Returns:
+        String: etag of the table
+    """
+    return syn.tableQuery("SELECT * FROM %s LIMIT 1" % table_id, resultsAs="rowset").etag
+
+class TableSchemaRegistry:
+    """Table entities and column models of the tables of a run
+
+    Every table is fetched once, either up front for all tables of the
+    run with prefetch, or on its first use. The column names of every
+    table are kept in table order and as a set for intersections.
+
+    Args:
+        syn: Synapse credential
+    """
+
+    def __init__(self, syn):
+        self.syn = syn
+        self._schemas = {}
+        self._columns = {}
+        self._column_names = {}
+        self._column_name_sets = {}
+        self._lock = threading.Lock()
+
+    def prefetch(self, table_ids, logger, workers=8):
+        """Fetch the tables that are not fetched yet concurrently
+
+        Args:
+            table_ids (list): Synapse IDs of the tables
+            logger: logger
+            workers (int): maximum number of tables fetched concurrently
+
+        Raises:
+            RuntimeError: if any of the tables could not be fetched
+        """
+        with self._lock:
+            table_ids = [table_id for table_id in dict.fromkeys(table_ids) if table_id not in self._schemas]
+        run_concurrently(lambda table_id, task_logger: self._fetch(table_id), table_ids, workers, logger, description="table schemas")
+
+    def _fetch(self, table_id):
+        table_schema = self.syn.get(table_id)
+        columns = list(self.syn.getColumns(table_id))
+        self._set(table_id, table_schema, columns)
+
+    def _set(self, table_id, table_schema, columns):
+        with self._lock:
+            self._schemas[table_id] = table_schema
+            self._columns[table_id] = columns
+            self._column_names[table_id] = [col['name'] for col in columns]
+            self._column_name_sets[table_id] = frozenset(self._column_names[table_id])
+
+    def _get(self, table_id, cache):
+        with self._lock:
+            if table_id in cache:
+                return(cache[table_id])
+        self._fetch(table_id)
+        with self._lock:
+            return(cache[table_id])
+
+    def get(self, table_id):
+        """Get the entity of a table"""
+        return(self._get(table_id, self._schemas))
+
+    def get_columns(self, table_id):
+        """Get the column models of a table"""
+        return(self._get(table_id, self._columns))
+
+    def get_column_names(self, table_id):
+        """Get the column names of a table in table order"""
+        return(self._get(table_id, self._column_names))
+
+    def get_column_name_set(self, table_id):
+        """Get the column names of a table as a set"""
+        return(self._get(table_id, self._column_name_sets))
+
+    def update(self, table_schema):
+        """Replace the entity of a table after it was stored, its columns are fetched again"""
+        self._set(table_schema.id, table_schema, list(self.syn.getColumns(table_schema.id)))
+
+class RecordIdIndex:
+    """Record IDs of Synapse Tables, optionally persisted to a local file
+
+    The record IDs of a table are only downloaded again when the etag of
+    the table has changed since they were stored.
+
+    Args:
+        path (String): JSON file to persist the index. Optional.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.tables = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as index_file:
+                self.tables = json.load(index_file)
+
+    def get_record_ids(self, syn, table_id):
+        """Get the set of record IDs in a table
+
+        Args:
+            syn: Synapse credential
+            table_id: Synapse ID of a table
+
+        Returns:
+            set: record IDs in the table
+        """
+        entry = self.tables.get(table_id)
+        # the etag is only checked for a table in the index
+        if entry is not None and entry["etag"] == get_table_etag(syn, table_id):
+            return set(entry["record_ids"])
+        query = syn.tableQuery(build_table_query(table_id, ["record_id"]))
+        record_ids = set(query.asDataFrame()["record_id"])
+        with self._lock:
+            self.tables[table_id] = {"etag": query.etag, "record_ids": sorted(record_ids)}
+        return record_ids
+
+    def save(self):
+        """Write the index to its file"""
+        if self.path:
+            with self._lock, open(self.path, "w") as index_file:
+                json.dump(self.tables, index_file)
+
+def get_input_versions(syn, synapse_ids):
+    """Get the current version of Synapse files
+
+    Args:
+        syn: Synapse credential
+        synapse_ids (dict): name to Synapse ID of a file
+
+    Returns:
+        dict: name to versioned Synapse ID, e.g. syn123.4
+    """
+    return({name: "%s.%s" % (synapse_id, syn.get(synapse_id, downloadFile=False).versionNumber)
+            for name, synapse_id in synapse_ids.items()})
+
+# annotation of a table with the cohort file versions last loaded into it
+COHORT_VERSIONS_ANNOTATION = "cohortVersions"
+
+def get_loaded_versions(table_schema):
+    """Get the cohort file versions last loaded into a table
+
+    Args:
+        table_schema (synapseclient.Schema): schema of the table
+
+    Returns:
+        dict: cohort to versioned Synapse ID of its file
+    """
+    values = table_schema.get(COHORT_VERSIONS_ANNOTATION, [])
+    if isinstance(values, str):
+        values = [values]
+    return(dict(value.split("=", 1) for value in values))
+
+def set_loaded_versions(syn, table_id, input_versions, partial=False):
+    """Annotate a table with the cohort file versions loaded into it
+
+    Args:
+        syn: Synapse credential
+        table_id (String): Synapse ID of the table
+        input_versions (dict): cohort to versioned Synapse ID of its file
+        partial (boolean): whether only some cohorts were loaded, so the
+            content fingerprint of the table is no longer known
+    """
+    annotations = syn.get_annotations(table_id)
+    annotations[COHORT_VERSIONS_ANNOTATION] = ["%s=%s" % (cohort, version) for cohort, version in input_versions.items()]
+    if partial:
+        annotations.pop(FINGERPRINT_ANNOTATION, None)
+    syn.set_annotations(annotations)
+
+def get_changed_cohorts(registry, table_ids, input_versions):
+    """Get the cohorts whose file version was not loaded into all of the tables
+
+    Args:
+        registry (TableSchemaRegistry): entities of the tables
+        table_ids (list): Synapse IDs of the tables
+        input_versions (dict): cohort to versioned Synapse ID of its file
+
+    Returns:
+        list: changed cohorts in the order of input_versions
+    """
+    changed = set()
+    for table_id in table_ids:
+        loaded_versions = get_loaded_versions(registry.get(table_id))
+        changed.update(cohort for cohort, version in input_versions.items() if loaded_versions.get(cohort) != version)
+    return([cohort for cohort in input_versions if cohort in changed])
+
+class RunManifest:
+    """Completed phases of every table in a run, persisted to a local file
+
+    The manifest is written after every completed phase, so a failed run
+    can be resumed from the first table that did not complete a phase.
+    Redacted tables also keep the record IDs they redacted.
+
+    Args:
+        path (String): JSON file of the manifest
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.inputs = None
+        self.tables = {}
+        self._lock = threading.Lock()
+
+    def start(self, inputs, resume=False):
+        """Start a run, or resume the run of the manifest file
+
+        Args:
+            inputs (dict): inputs of the run, e.g. table type and file versions
+            resume (bool): whether to keep the completed phases of the last run
+
+        Raises:
+            ValueError: if resuming a run of different inputs
+        """
+        if resume and os.path.exists(self.path):
+            with open(self.path) as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest["inputs"] != inputs:
+                raise ValueError("The inputs changed since the run in %s, it can not be resumed" % self.path)
+            self.tables = manifest["tables"]
+        else:
+            self.tables = {}
+        self.inputs = inputs
+        self._save()
+
+    def is_done(self, table_id, phase):
+        """Check if a table completed a phase, e.g. stored, redacted or snapshotted"""
+        with self._lock:
+            return phase in self.tables.get(table_id, {}).get("phases", [])
+
+    def set_done(self, table_id, phase, records=None):
+        """Record that a table completed a phase
+
+        Args:
+            table_id (String): Synapse ID of the table
+            phase (String): completed phase
+            records (list): record IDs redacted in the table. Optional.
+        """
+        with self._lock:
+            entry = self.tables.setdefault(table_id, {"phases": []})
+            if phase not in entry["phases"]:
+                entry["phases"].append(phase)
+            if records is not None:
+                entry["records"] = list(records)
+        self._save()
+
+    def get_records(self, table_id):
+        """Get the record IDs redacted in a table"""
+        with self._lock:
+            return list(self.tables.get(table_id, {}).get("records", []))
+
+    def _save(self):
+        with self._lock:
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as manifest_file:
+                json.dump({"inputs": self.inputs, "tables": self.tables}, manifest_file, indent=2)
+            os.replace(temp_path, self.path)
+
+def get_catalog_dtypes(data_element_catalog):
+    """Build the dtypes of the label data columns from the data element catalog
+
+    INTEGER variables are read as nullable integers, DOUBLE variables as
+    floats and STRING variables with a fixed set of choices as categories.
+
+    Args:
+        data_element_catalog (Dataframe): curated variables of the catalog
+
+    Returns:
+        dict: column name to dtype
+    """
+    dtypes = {}
+    for _, row in data_element_catalog.iterrows():
+        if row['synColType'] == "INTEGER":
+            dtype = "Int64"
+        elif row['synColType'] == "DOUBLE":
+            dtype = "float64"
+        elif row['synColType'] == "STRING" and row['type'] in CHOICE_TYPES:
+            dtype = "category"
+        else:
+            continue
+        if row['type'] == "checkbox":
+            if pandas.isna(row['colLabels']):
+                continue
+            for label in row['colLabels'].split(','):
+                dtypes[row['variable']+"___"+label] = dtype
+        else:
+            dtypes[row['variable']] = dtype
+    return dtypes
+
+def apply_catalog_dtypes(df, dtypes):
+    """Convert the columns of label data to the catalog dtypes
+
+    A column is only converted when no value is lost, e.g. an INTEGER
+    variable with pre-redacted values such as ">32485" stays as read.
+
+    Args:
+        df (Dataframe): label data, converted in place
+        dtypes (dict): column name to dtype
+
+    Returns:
+        Dataframe: label data
+    """
+    for col in df.columns.intersection(list(dtypes)):
+        values = df[col]
+        all_null = values.isnull().all()
+        if dtypes[col] == "Int64":
+            if values.dtype.kind in "iu" or all_null:
+                df[col] = values.astype("Int64")
+            elif values.dtype.kind == "f" and (values.dropna() % 1 == 0).all():
+                df[col] = values.astype("Int64")
+        elif dtypes[col] == "float64":
+            if values.dtype.kind in "iuf" or all_null:
+                df[col] = values.astype("float64")
+        elif dtypes[col] == "category":
+            if values.dtype == object or all_null:
+                df[col] = values.astype("category")
+    return df
+
+def concat_label_data(frames, **kwargs):
+    """Concatenate label data keeping the categorical columns categorical
+
+    Args:
+        frames (list): label data to concatenate
+        **kwargs: passed to pandas.concat
+
+    Returns:
+        Dataframe: concatenated label data
+    """
+    categories = {}
+    for frame in frames:
+        for col in frame.columns[frame.dtypes == "category"]:
+            categories[col] = categories.get(col, pandas.Index([])).union(frame[col].cat.categories)
+    aligned = []
+    for frame in frames:
+        frame = frame.copy(deep=False)
+        for col in frame.columns.intersection(list(categories)):
+            if frame[col].dtype == "category":
+                frame[col] = frame[col].cat.set_categories(categories[col])
+        aligned.append(frame)
+    return pandas.concat(aligned, **kwargs)
+
+def _read_label_file(path):
+    if path.endswith(".parquet"):
+        return pandas.read_parquet(path, memory_map=True)
+    return pandas.read_csv(path, low_memory=False, na_values=NA_VALUES, keep_default_na=False)
+
+def get_data(syn, label_data_id, cohort, dtypes=None, cache=None):
+    """Download csv or Parquet file from Synapse and add cohort column
     
     Args:
         syn (Object): Synapse credential
-        label_data_id (String): Synapse ID of a csv file
+        label_data_id (String): Synapse ID of a csv or Parquet file
         cohort: cohort value to be added as a column
+        dtypes (dict): column dtypes from the data element catalog. Optional.
+        cache (SynapseCache): local cache. Optional.
     
     Returns:
         Dataframe: label data
     """
-    na_values = ["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "n/a", "nan", "null"]
-    label_data = pandas.read_csv(syn.get(label_data_id).path, low_memory=False, na_values=na_values, keep_default_na=False)
+    label_data = cached_read_file(syn, label_data_id, _read_label_file, cache)
     label_data['cohort'] = cohort
+    if dtypes:
+        label_data = apply_catalog_dtypes(label_data, dtypes)
     return(label_data)
 
+def get_cohort_data(syn, cohort_data_ids, logger, dtypes=None, cache=None, workers=1):
+    """Download the label data of all cohorts concurrently
+
+    Every file is downloaded and parsed by a thread of a pool, so files are
+    parsed while the others are still downloading. The parsers release the
+    GIL, and the parsed data stays in the process instead of being copied
+    back from worker processes. The label data is concatenated in the
+    order of the cohorts.
+
+    Args:
+        syn (Object): Synapse credential
+        cohort_data_ids (dict): cohort to Synapse ID of its label data file
+        logger: logger
+        dtypes (dict): column dtypes from the data element catalog. Optional.
+        cache (SynapseCache): local cache. Optional.
+        workers (int): maximum number of concurrent downloads and parses
+
+    Returns:
+        Dataframe: label data of all cohorts
+    """
+    cohort_data = run_concurrently(
+        lambda cohort, task_logger: get_data(syn, cohort_data_ids[cohort], cohort, dtypes, cache),
+        cohort_data_ids, workers, logger, description="cohort files")
+    return(concat_label_data(list(cohort_data.values()), axis=0, ignore_index=True))
+
+class LabelData:
+    """Label data partitioned by REDCap repeat instrument
+
+    Attributes:
+        forms (dict): form label to the rows of that form. Rows without a
+            repeat instrument are stored under "non-repeating"
+        columns (list): columns of the label data
+    """
+
+    def __init__(self, forms, columns):
+        self.forms = forms
+        self.columns = list(columns)
+        self._column_set = set(self.columns)
+
+    def add_column(self, column):
+        """Add a column without any data to the label data
+
+        Args:
+            column (String): name of the column
+        """
+        if column not in self._column_set:
+            self.columns.append(column)
+            self._column_set.add(column)
+
+    def get_table_columns(self, table_columns):
+        """Get the table columns that are found in the label data
+
+        Args:
+            table_columns (list): column names of a Synapse table
+
+        Returns:
+            list: column names in both the table and the label data
+        """
+        return [col for col in table_columns if col in self._column_set]
+
+    def get_form_data(self, form_label, columns):
+        """Get the data of a form with the given columns
+
+        Args:
+            form_label (String): form label of the table
+            columns (list): columns of the label data to select
+
+        Returns:
+            Dataframe: data of the form
+        """
+        form_data = self.forms.get(form_label)
+        if form_data is None:
+            return pandas.DataFrame(columns=columns)
+        return form_data.reindex(columns=columns)
+
+def partition_label_data(label_data):
+    """Partition label data by REDCap repeat instrument in one pass
+
+    The rows are sorted by instrument once so every form is a contiguous
+    slice (a view) of the sorted data.
+
+    Args:
+        label_data (Dataframe): label data of all cohorts
+
+    Returns:
+        LabelData: partitioned label data
+    """
+    instruments = label_data["redcap_repeat_instrument"].fillna("non-repeating")
+    codes, form_labels = pandas.factorize(instruments)
+    order = numpy.argsort(codes, kind="stable")
+    sorted_data = label_data.take(order)
+    bounds = numpy.concatenate(
+        [[0], numpy.cumsum(numpy.bincount(codes, minlength=len(form_labels)))]
+    )
+    forms = {
+        form_label: sorted_data.iloc[bounds[i]:bounds[i+1]]
+        for i, form_label in enumerate(form_labels)
+    }
+    return LabelData(forms, label_data.columns)
+
+class ParquetLabelData(LabelData):
+    """Partitioned label data read from Parquet files written by
+    write_label_data_parquet or stream_label_data
+
+    Every form is stored in its own files, which are memory-mapped and only
+    read for the columns a table needs.
+
+    Args:
+        path (String): directory of the Parquet files
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "columns.json")) as columns_file:
+            columns = json.load(columns_file)
+        with open(os.path.join(path, "forms.json")) as forms_file:
+            forms = {
+                form_label: [os.path.join(path, file_name) for file_name in (file_names if isinstance(file_names, list) else [file_names])]
+                for form_label, file_names in json.load(forms_file).items()
+            }
+        super().__init__(forms, columns)
+
+    def get_form_data(self, form_label, columns):
+        """Get the data of a form with the given columns
+
+        Args:
+            form_label (String): form label of the table
+            columns (list): columns of the label data to select
+
+        Returns:
+            Dataframe: data of the form
+        """
+        import pyarrow.parquet
+
+        form_paths = self.forms.get(form_label)
+        if form_paths is None:
+            return pandas.DataFrame(columns=columns)
+        parts = []
+        for form_path in form_paths:
+            form_columns = set(pyarrow.parquet.read_schema(form_path).names)
+            parts.append(pyarrow.parquet.read_pandas(
+                form_path,
+                columns=[col for col in columns if col in form_columns],
+                memory_map=True,
+            ).to_pandas())
+        form_data = parts[0] if len(parts) == 1 else concat_label_data(parts, axis=0)
+        return form_data.reindex(columns=columns)
+
+def to_arrow_compatible(df):
+    """Turn the non-text values of mixed object columns into text
+
+    float_to_int gives the same result for the text as for the value.
+
+    Args:
+        df (pandas.DataFrame): data, modified in place
+
+    Returns:
+        pandas.DataFrame: data that can be written to Parquet
+    """
+    for col in df.columns[df.dtypes == object]:
+        if pandas.api.types.infer_dtype(df[col], skipna=True) not in ("string", "empty"):
+            df[col] = df[col].map(lambda x: x if isinstance(x, str) or pandas.isna(x) else str(x))
+    return df
+
+def write_label_data_parquet(label_data, path, input_versions=None):
+    """Write partitioned label data to a directory of Parquet files
+
+    Every form is written to its own file with only the columns holding
+    data for that form. The files are read back with ParquetLabelData.
+
+    Args:
+        label_data (LabelData): partitioned label data
+        path (String): output directory
+        input_versions (dict): cohort to versioned Synapse ID of the file
+            the label data was read from. Optional.
+    """
+    os.makedirs(path, exist_ok=True)
+    forms = {}
+    for i, form_label in enumerate(label_data.forms):
+        form_data = label_data.get_form_data(form_label, label_data.columns)
+        form_data = to_arrow_compatible(form_data.dropna(axis=1, how="all"))
+        file_name = "form_%s.parquet" % i
+        form_data.to_parquet(os.path.join(path, file_name))
+        forms[form_label] = file_name
+    _write_label_data_index(path, forms, label_data.columns, input_versions)
+
+def _write_label_data_index(path, forms, columns, input_versions=None):
+    """Write the form files, columns and input versions of Parquet label data"""
+    with open(os.path.join(path, "forms.json"), "w") as forms_file:
+        json.dump(forms, forms_file)
+    with open(os.path.join(path, "columns.json"), "w") as columns_file:
+        json.dump(list(columns), columns_file)
+    if input_versions is not None:
+        with open(os.path.join(path, "inputs.json"), "w") as inputs_file:
+            json.dump(input_versions, inputs_file)
+
+def get_label_data_versions(path):
+    """Get the versions of the cohort files Parquet label data was read from
+
+    Args:
+        path (String): directory of the Parquet files
+
+    Raises:
+        ValueError: if the versions were not written with the label data
+
+    Returns:
+        dict: cohort to versioned Synapse ID of its file
+    """
+    inputs_path = os.path.join(path, "inputs.json")
+    if not os.path.exists(inputs_path):
+        raise ValueError("%s has no input versions, write the label data again" % path)
+    with open(inputs_path) as inputs_file:
+        return(json.load(inputs_file))
+
+def _iter_label_file(path, chunksize, dtype=None):
+    """Read a csv or Parquet label data file in chunks of rows"""
+    if path.endswith(".parquet"):
+        import pyarrow.parquet
+
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunksize):
+            chunk = batch.to_pandas()
+            yield chunk if dtype is None else chunk.astype(dtype)
+    else:
+        yield from pandas.read_csv(path, chunksize=chunksize, dtype=dtype, na_values=NA_VALUES, keep_default_na=False)
+
+def _scan_label_file_dtypes(path, chunksize, dtypes=None):
+    """Find the dtypes to read every chunk of a label data file with
+
+    A column is numeric if all of its values in the file are numbers, as
+    when the whole file is read at once, and gets its catalog dtype when no
+    value is lost, as with apply_catalog_dtypes.
+
+    Args:
+        path (String): csv or Parquet file
+        chunksize (int): number of rows read at a time
+        dtypes (dict): column dtypes from the data element catalog. Optional.
+
+    Returns:
+        dict: column name to dtype
+    """
+    dtypes = dtypes or {}
+    non_numeric = {}
+    fractional = {}
+    all_null = {}
+    scan_dtype = None if path.endswith(".parquet") else object
+    for chunk in _iter_label_file(path, chunksize, scan_dtype):
+        for col in chunk.columns:
+            values = chunk[col]
+            if values.dtype.kind in "iuf":
+                numbers = values
+            else:
+                numbers = pandas.to_numeric(values.astype(object), errors="coerce")
+            not_null = values.notnull()
+            non_numeric[col] = non_numeric.get(col, False) or bool((not_null & numbers.isnull()).any())
+            fractional[col] = fractional.get(col, False) or bool((numbers.dropna() % 1 != 0).any())
+            all_null[col] = all_null.get(col, True) and not not_null.any()
+    read_dtypes = {}
+    for col in non_numeric:
+        if non_numeric[col]:
+            read_dtypes[col] = "category" if dtypes.get(col) == "category" else object
+        elif dtypes.get(col) == "Int64" and not fractional[col]:
+            read_dtypes[col] = "Int64"
+        elif dtypes.get(col) == "category" and all_null[col]:
+            read_dtypes[col] = "category"
+        else:
+            read_dtypes[col] = "float64"
+    return read_dtypes
+
+def stream_label_data(syn, cohort_data_ids, chunksize, path, dtypes=None, input_versions=None):
+    """Read the cohort files in chunks straight into Parquet form partitions
+
+    The label data is never held in memory. Rows of every chunk are routed
+    to their repeat instrument and written to a Parquet file of that form,
+    without the columns that have no data for the form. Every file is
+    scanned first, so all of its chunks are read with the same dtypes.
+
+    Args:
+        syn (Object): Synapse credential
+        cohort_data_ids (dict): cohort to Synapse ID of its csv or Parquet file
+        chunksize (int): number of rows read at a time
+        path (String): directory of the Parquet files
+        dtypes (dict): column dtypes from the data element catalog. Optional.
+        input_versions (dict): cohort to versioned Synapse ID of its file,
+            written with the label data. Optional.
+
+    Returns:
+        ParquetLabelData: partitioned label data
+    """
+    os.makedirs(path, exist_ok=True)
+    forms = {}
+    columns = {}
+    offset = 0
+    for cohort, label_data_id in cohort_data_ids.items():
+        with STAGE_METRICS.stage("download", label_data_id) as record:
+            file_path = syn.get(label_data_id).path
+            record["bytes"] = _file_size(file_path)
+        with STAGE_METRICS.stage("parse", label_data_id) as record:
+            read_dtypes = _scan_label_file_dtypes(file_path, chunksize, dtypes)
+            n_rows = 0
+            n_columns = 0
+            for chunk in _iter_label_file(file_path, chunksize, read_dtypes):
+                chunk['cohort'] = cohort
+                # same row labels as concatenating the full cohort data
+                chunk.index = pandas.RangeIndex(offset + n_rows, offset + n_rows + len(chunk))
+                n_rows += len(chunk)
+                n_columns = len(chunk.columns)
+                columns.update(dict.fromkeys(chunk.columns))
+                instruments = chunk["redcap_repeat_instrument"].astype(object).fillna("non-repeating")
+                for form_label, form_data in chunk.groupby(instruments, sort=False):
+                    form_files = forms.setdefault(form_label, [])
+                    file_name = "form_%s_%s.parquet" % (list(forms).index(form_label), len(form_files))
+                    form_data = to_arrow_compatible(form_data.dropna(axis=1, how="all"))
+                    form_data.to_parquet(os.path.join(path, file_name))
+                    form_files.append(file_name)
+            record["rows"], record["columns"] = n_rows, n_columns
+        offset += n_rows
+    _write_label_data_index(path, forms, columns, input_versions)
+    return ParquetLabelData(path)
+
 def setup_custom_logger(name):
     """Set up customer logger
 
@@ -95,6 +1207,146 @@ def setup_custom_logger(name):
     logger.addHandler(screen_handler)
     return(logger)
 
+def _peak_rss():
+    """Peak resident set size of the process and its children in bytes"""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return(peak if sys.platform == "darwin" else peak * 1024)
+
+class StageMetrics:
+    """Performance metrics of the stages of a run
+
+    Every stage records its wall time in seconds, the rows and columns it
+    processed, the bytes it transferred and the peak RSS of the process in
+    bytes at its end.
+
+    Attributes:
+        records (list): metrics of every stage run, in the order they ended
+    """
+
+    FIELDS = ["stage", "table", "wall_time", "rows", "columns", "bytes", "peak_rss"]
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, stage, table=None):
+        """Measure a stage of the run
+
+        Args:
+            stage (String): name of the stage, e.g. download or upload
+            table (String): table, form or Synapse ID the stage ran for
+
+        Yields:
+            dict: metrics of the stage. rows, columns and bytes can be set
+                by the caller
+        """
+        record = dict.fromkeys(self.FIELDS)
+        record.update(stage=stage, table=table)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["wall_time"] = time.perf_counter() - start
+            record["peak_rss"] = _peak_rss()
+            with self._lock:
+                self.records.append(record)
+
+    def clear(self):
+        with self._lock:
+            self.records = []
+
+    def write(self, prefix="metrics"):
+        """Write the metrics to <prefix>.json and <prefix>.csv
+
+        Args:
+            prefix (String): path of the files without extension
+        """
+        with self._lock:
+            records = list(self.records)
+        with open(prefix + ".json", "w") as metrics_file:
+            json.dump(records, metrics_file, indent=2, default=int)
+        pandas.DataFrame(records, columns=self.FIELDS).to_csv(prefix + ".csv", index=False)
+
+# Metrics of the current run, written next to log.txt
+STAGE_METRICS = StageMetrics()
+
+class _BufferHandler(logging.Handler):
+    """Keep log records in memory to be replayed later"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+def run_concurrently(func, items, workers, logger, description="tasks"):
+    """Run a function for every item with a bounded thread pool
+
+    Each task logs through its own buffered logger. The records are
+    replayed in the order of the items, so the log reads the same as a
+    serial run. With a single worker, the tasks run in turn and log
+    directly. A failing task does not stop the other tasks; the failures
+    are reported in the final summary.
+
+    Args:
+        func: function called as func(item, logger)
+        items (list): items to run the function for
+        workers (int): maximum number of concurrent tasks
+        logger: logger
+        description (String): what the items are, for the summary
+
+    Raises:
+        RuntimeError: if any of the tasks failed
+
+    Returns:
+        dict: item to result of the function, in the order of the items
+    """
+    items = list(items)
+    results = {}
+    failures = {}
+
+    def _run(item, task_logger):
+        try:
+            return func(item, task_logger), None
+        except Exception as e:
+            task_logger.exception("Failed: %s" % item)
+            return None, e
+
+    def _run_buffered(item):
+        task_logger = logging.Logger("%s.%s" % (logger.name, item), logger.level)
+        handler = _BufferHandler()
+        task_logger.addHandler(handler)
+        return _run(item, task_logger) + (handler.records,)
+
+    def _outcomes():
+        if workers <= 1:
+            for item in items:
+                yield item, _run(item, logger)
+            return
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_run_buffered, item) for item in items]
+            for item, future in zip(items, futures):
+                result, error, records = future.result()
+                for record in records:
+                    logger.handle(record)
+                yield item, (result, error)
+
+    for item, (result, error) in _outcomes():
+        if error is None:
+            results[item] = result
+        else:
+            failures[item] = error
+    logger.info("Completed %s of %s %s" % (len(results), len(items), description))
+    if failures:
+        summary = ["%s: %r" % (item, error) for item, error in failures.items()]
+        logger.error("Failed %s:\n%s" % (description, "\n".join(summary)))
+        raise RuntimeError("%s of %s %s failed" % (len(failures), len(items), description))
+    return results
+
 def synapse_login(synapse_config):
     """Log into Synapse
 
@@ -115,7 +1367,80 @@ def update_version(syn, table_id, comment):
     """
     Update the table version with given table ID and comment
     """
-    syn.restPOST("/entity/%s/table/snapshot" % table_id, body='{"snapshotComment":"%s"}' % comment)
+    syn.restPOST("/entity/%s/table/snapshot" % table_id, body=json.dumps({"snapshotComment": comment}))
+
+def _snapshot_table(syn, table_id, comment, logger):
+    """Create a snapshot version of a table through an asynchronous table transaction
+
+    Raises:
+        SynapseError: if the snapshot failed
+
+    Returns:
+        int: snapshot version number
+    """
+    uri = "/entity/%s/table/transaction/async" % table_id
+    request = {
+        "concreteType": "org.sagebionetworks.repo.model.table.TableUpdateTransactionRequest",
+        "entityId": table_id,
+        "changes": [],
+        "createSnapshot": True,
+        "snapshotOptions": {"snapshotComment": comment}
+    }
+    with STAGE_METRICS.stage("snapshot", table_id):
+        result = syn._waitForAsync(uri, request)
+    logger.info("Created version %s of %s" % (result.get("snapshotVersionNumber"), table_id))
+    return(result.get("snapshotVersionNumber"))
+
+def snapshot_tables(syn, table_ids, comment, logger, workers=8, manifest=None, fingerprints=None, input_versions=None, partial=False):
+    """Create a snapshot version of every table concurrently
+
+    The snapshots are submitted as asynchronous table transactions and
+    waited on by the Synapse client. A failed snapshot is not retried, as
+    a request that was committed would create another version.
+
+    Args:
+        syn: Synapse credential
+        table_ids (list): Synapse IDs of the tables
+        comment (String): version comment
+        logger: logger
+        workers (int): maximum number of concurrent snapshots
+        manifest (RunManifest): skips and records the snapshotted tables. Optional.
+        fingerprints (TableFingerprints): skips the unchanged tables and
+            annotates the others with their fingerprint. Optional.
+        input_versions (dict): cohort to versioned Synapse ID of the files
+            loaded into the tables, annotated on the snapshotted and the
+            unchanged tables. Optional.
+        partial (boolean): whether only some cohorts were loaded
+
+    Raises:
+        RuntimeError: if any of the snapshots failed
+
+    Returns:
+        dict: table ID to snapshot version number
+    """
+    if manifest is not None:
+        table_ids = [table_id for table_id in table_ids if not manifest.is_done(table_id, "snapshotted")]
+    skipped = []
+    if fingerprints is not None:
+        skipped = [table_id for table_id in table_ids if fingerprints.is_skipped(table_id)]
+        table_ids = [table_id for table_id in table_ids if table_id not in skipped]
+
+    def _snapshot(table_id, task_logger):
+        version = _snapshot_table(syn, table_id, comment, task_logger)
+        if fingerprints is not None:
+            fingerprints.save(syn, table_id)
+        if input_versions is not None:
+            set_loaded_versions(syn, table_id, input_versions, partial)
+        if manifest is not None:
+            manifest.set_done(table_id, "snapshotted")
+        return(version)
+
+    versions = run_concurrently(_snapshot, table_ids, workers, logger, description="table snapshots")
+    if input_versions is not None:
+        # the unchanged tables already hold the data of these versions
+        for table_id in skipped:
+            set_loaded_versions(syn, table_id, input_versions)
+    return(versions)
     
 def revert_table_version(syn, table_id):
     """Revert table data to previous version
@@ -128,10 +1453,10 @@ def revert_table_version(syn, table_id):
     table_columns = syn.getColumns(table_schema.columnIds)
     table_columns = [col['name'] for col in list(table_columns)]
     previous_version_num = table_schema.versionNumber-1
-    old_data = syn.tableQuery('SELECT * FROM %s.%s' % (table_id, previous_version_num)).asDataFrame()
+    old_data = syn.tableQuery(build_table_query('%s.%s' % (table_id, previous_version_num))).asDataFrame()
     old_data = old_data.reset_index(drop=True)
     table_columns = list(set(table_columns) & set(old_data.columns)) 
     temp_data = old_data[table_columns]
-    table_query = syn.tableQuery("SELECT * from %s" % table_id)
+    table_query = syn.tableQuery(build_table_query(table_id))
     syn.delete(table_query.asRowSet())
     syn.store(Table(table_schema, temp_data))
\ No newline at end of file
@@ -0,0 +1,105 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# patients x forms x columns per form of the synthetic label data. Select
+# scales with BPC_BENCH_SCALES, e.g. BPC_BENCH_SCALES=small,large
+SCALES = {
+    "small": (200, 5, 20),
+    "medium": (2000, 10, 50),
+    "large": (10000, 20, 100),
+}
+
+
+def make_form_data(n_rows, n_cols, density=0.1, seed=0):
+    """Synthetic REDCap form export: key columns plus sparse data columns"""
+    rng = np.random.default_rng(seed)
+    data = {
+        "cohort": rng.choice(["NSCLC", "CRC", "BrCa"], n_rows),
+        "record_id": [f"GENIE-{i // 3}" for i in range(n_rows)],
+        "redcap_data_access_group": rng.choice(["DFCI", "MSK", "VICC"], n_rows),
+        "redcap_repeat_instance": rng.integers(1, 10, n_rows).astype(float),
+    }
+    for i in range(n_cols):
+        values = rng.integers(0, 5000, n_rows).astype(float)
+        values[rng.random(n_rows) > density] = np.nan
+        data[f"var_{i}"] = values
+    df = pd.DataFrame(data)
+    # a quarter of the rows only hold the REDCap bookkeeping columns
+    data_cols = [f"var_{i}" for i in range(n_cols)]
+    df.loc[rng.random(n_rows) < 0.25, data_cols] = np.nan
+    return df
+
+
+def make_label_data(n_patients, n_forms, n_cols, density=0.3, seed=0):
+    """Synthetic merged REDCap export of a cohort
+
+    Every patient has one non-repeating row and one to four instances of
+    every form. Each form has n_cols variables, of which a quarter are day
+    intervals (form_<i>_int_<j>) that can exceed the PHI cutoff.
+    """
+    rng = np.random.default_rng(seed)
+    records = np.array([f"GENIE-{i}" for i in range(n_patients)])
+    parts = [
+        pd.DataFrame(
+            {
+                "cohort": rng.choice(["NSCLC", "CRC", "BrCa"], n_patients),
+                "record_id": records,
+                "redcap_data_access_group": rng.choice(["DFCI", "MSK"], n_patients),
+                "birth_year": rng.integers(1920, 2000, n_patients).astype(float),
+                "hybrid_death_ind": rng.choice(["Yes", "No"], n_patients),
+                "curation_dt": pd.Series(
+                    pd.Timestamp("2018-01-01")
+                    + pd.to_timedelta(rng.integers(0, 2000, n_patients), unit="D")
+                ).dt.strftime("%Y-%m-%d"),
+            }
+        )
+    ]
+    for form in range(n_forms):
+        n_instances = rng.integers(1, 5, n_patients)
+        n_rows = n_instances.sum()
+        form_data = {
+            "cohort": np.repeat(parts[0]["cohort"].to_numpy(), n_instances),
+            "record_id": np.repeat(records, n_instances),
+            "redcap_data_access_group": np.repeat(
+                parts[0]["redcap_data_access_group"].to_numpy(), n_instances
+            ),
+            "redcap_repeat_instrument": f"form_{form}",
+            "redcap_repeat_instance": np.concatenate(
+                [np.arange(1, n + 1) for n in n_instances]
+            ).astype(float),
+        }
+        for i in range(n_cols):
+            if i < n_cols // 4:
+                values = rng.integers(0, 34000, n_rows).astype(float)
+                name = f"form_{form}_int_{i}"
+            else:
+                values = rng.integers(0, 10, n_rows).astype(float)
+                name = f"form_{form}_var_{i}"
+            values[rng.random(n_rows) > density] = np.nan
+            form_data[name] = values
+        parts.append(pd.DataFrame(form_data))
+    return pd.concat(parts, ignore_index=True)
+
+
+def _selected_scales():
+    return os.environ.get("BPC_BENCH_SCALES", "small").split(",")
+
+
+@pytest.fixture(scope="session")
+def cohort_form_data():
+    return make_form_data(n_rows=5000, n_cols=100)
+
+
+@pytest.fixture(scope="session", params=_selected_scales())
+def label_data(request):
+    return make_label_data(*SCALES[request.param])
+
+
+@pytest.fixture(scope="session")
+def interval_cols_info(label_data):
+    # interval variables of the synthetic label data with their unit
+    variables = [col for col in label_data.columns if "_int_" in col]
+    return pd.DataFrame({"variable": variables, "unit": "day"})
@@ -0,0 +1,27 @@
+import pytest
+
+from scripts.table_updates import utilities
+
+pytest.importorskip("pytest_benchmark")
+
+COLS_TO_SKIP = [
+    "cohort",
+    "record_id",
+    "redcap_data_access_group",
+    "redcap_repeat_instance",
+]
+
+
+@pytest.mark.benchmark(group="empty_row")
+def test_bench_check_empty_row_row_wise(benchmark, cohort_form_data):
+    benchmark.pedantic(
+        cohort_form_data.apply,
+        args=(lambda row: utilities.check_empty_row(row, COLS_TO_SKIP),),
+        kwargs={"axis": 1},
+        rounds=3,
+    )
+
+
+@pytest.mark.benchmark(group="empty_row")
+def test_bench_check_empty_rows_vectorized(benchmark, cohort_form_data):
+    benchmark(utilities.check_empty_rows, cohort_form_data, COLS_TO_SKIP)
@@ -0,0 +1,106 @@
+from unittest import mock
+
+import pytest
+
+from scripts.table_updates import update_data_table, utilities
+
+pytest.importorskip("pytest_benchmark")
+
+KEY_COLUMNS = ["cohort", "record_id", "redcap_repeat_instance"]
+
+
+@pytest.fixture(scope="session")
+def partitioned_label_data(label_data):
+    partitioned = utilities.partition_label_data(label_data)
+    partitioned.add_column("redacted")
+    return partitioned
+
+
+@pytest.fixture(scope="session")
+def form_table(label_data):
+    # the stored data of the first repeating form
+    columns = KEY_COLUMNS + ["redcap_data_access_group"]
+    columns += [col for col in label_data.columns if "form_0_" in col]
+    form_data = label_data.loc[
+        label_data["redcap_repeat_instrument"] == "form_0", columns
+    ]
+    return utilities.float_to_int_df(form_data.reset_index(drop=True))
+
+
+@pytest.fixture
+def form_syn(form_table):
+    syn = mock.MagicMock()
+    table_schema = mock.MagicMock(
+        form_label=["form_0"], form=["form_0"], columnIds=list(form_table.columns)
+    )
+    table_schema.name = "Form 0"
+    syn.get.return_value = table_schema
+    syn.getColumns.return_value = [{"name": col} for col in form_table.columns]
+    return syn
+
+
+@pytest.mark.benchmark(group="store_data")
+def test_bench_store_data(benchmark, monkeypatch, form_syn, partitioned_label_data):
+    monkeypatch.setattr(
+        update_data_table, "_update_table_rows", mock.MagicMock(return_value=0)
+    )
+    benchmark(
+        update_data_table._store_data,
+        form_syn,
+        "syn1",
+        partitioned_label_data,
+        "primary",
+        mock.MagicMock(),
+        False,
+    )
+
+
+@pytest.mark.benchmark(group="diff_table_rows")
+def test_bench_diff_table_rows(benchmark, form_table):
+    existing = form_table.copy()
+    existing.index = [f"{i}_1" for i in range(len(existing))]
+    new = form_table.copy()
+    changed = new.index[::100]
+    new.loc[changed, new.columns[-1]] = "changed"
+    to_insert, to_update, to_delete = benchmark(
+        utilities.diff_table_rows, existing, new, KEY_COLUMNS
+    )
+    assert len(to_update) == len(changed)
+
+
+@pytest.mark.benchmark(group="partition")
+def test_bench_partition_label_data(benchmark, label_data):
+    benchmark(utilities.partition_label_data, label_data)
+
+
+@pytest.mark.benchmark(group="float_to_int")
+def test_bench_float_to_int_element_wise(benchmark, label_data):
+    benchmark.pedantic(
+        label_data.apply, args=(lambda col: col.map(utilities.float_to_int),), rounds=3
+    )
+
+
+@pytest.mark.benchmark(group="float_to_int")
+def test_bench_float_to_int_df(benchmark, label_data):
+    benchmark(utilities.float_to_int_df, label_data)
+
+
+@pytest.mark.benchmark(group="redaction")
+def test_bench_redact_table(benchmark, label_data, interval_cols_info):
+    cutoffs = update_data_table.get_interval_cutoffs(interval_cols_info)
+    benchmark.pedantic(
+        update_data_table._redact_table,
+        setup=lambda: ((label_data.copy(), cutoffs), {}),
+        rounds=5,
+    )
+
+
+@pytest.mark.benchmark(group="redaction")
+def test_bench_to_redact_birth_year(benchmark, label_data):
+    patients = label_data[label_data["redcap_repeat_instrument"].isnull()]
+    benchmark(
+        update_data_table._to_redact_birth_year,
+        patients["birth_year"],
+        patients["curation_dt"],
+        patients["hybrid_death_ind"],
+    )
@@ -1,14 +1,22 @@
+import datetime
+import functools
 import json
+import logging
 import os
 import pytest
 import re
+import threading
+import time
 from unittest import mock
 
+import numpy as np
 import pandas as pd
+import requests
 import synapseclient
 
 from scripts.table_updates import (
     update_data_table,
+    utilities,
 )
 
 
@@ -74,36 +82,38 @@ def config():
 
 
 def test_get_main_genie_clinical_sample_file_success(
-    mock_synapse, mock_release_version
+    mock_synapse, mock_release_version, monkeypatch
 ):
     mock_syn, mock_release_files_table_synid = mock_synapse
     # Mock pandas.read_csv to return a non-empty DataFrame
     clinical_df_mock = pd.DataFrame(
         {"SAMPLE_ID": [1, 2, 3], "SEQ_YEAR": [2014, 2014, 2013], "OTHER_ID": [6, 7, 8]}
     )
-    pd.read_csv = mock.MagicMock(return_value=clinical_df_mock)
+    monkeypatch.setattr(pd, "read_csv", mock.MagicMock(return_value=clinical_df_mock))
 
     # Call the function
     update_data_table.get_main_genie_clinical_sample_file(
         mock_syn, mock_release_version, mock_release_files_table_synid
     )
     mock_syn.tableQuery.assert_called_once_with(
-        f"SELECT * FROM {mock_release_files_table_synid}"
+        f"SELECT fileSynId FROM {mock_release_files_table_synid} "
+        f"WHERE release = '{mock_release_version}' "
+        "AND name = 'data_clinical_sample.txt'"
     )
     # Assert that syn.get was called in order
     mock_syn.get.assert_called_with("syn23456", followLink=True)
     pd.read_csv.assert_called_once_with(
-        "path/to/clinical_file.csv", sep="\t", skiprows=4
+        "path/to/clinical_file.csv", sep="\t", skiprows=4, usecols=mock.ANY
     )
 
 
 def test_get_main_genie_clinical_sample_file_empty_file(
-    mock_synapse, mock_release_version
+    mock_synapse, mock_release_version, monkeypatch
 ):
     mock_syn, mock_release_files_table_synid = mock_synapse
 
     # Mock pandas.read_csv to return an empty DataFrame
-    pd.read_csv = mock.MagicMock(return_value=pd.DataFrame())
+    monkeypatch.setattr(pd, "read_csv", mock.MagicMock(return_value=pd.DataFrame()))
 
     # Call the function and assert the assertion error is raised
     with pytest.raises(
@@ -114,22 +124,26 @@ def test_get_main_genie_clinical_sample_file_empty_file(
         )
 
     mock_syn.tableQuery.assert_called_once_with(
-        f"SELECT * FROM {mock_release_files_table_synid}"
+        f"SELECT fileSynId FROM {mock_release_files_table_synid} "
+        f"WHERE release = '{mock_release_version}' "
+        "AND name = 'data_clinical_sample.txt'"
     )
     # Assert that syn.get was called in order
     mock_syn.get.assert_called_with("syn23456", followLink=True)
     pd.read_csv.assert_called_once_with(
-        "path/to/clinical_file.csv", sep="\t", skiprows=4
+        "path/to/clinical_file.csv", sep="\t", skiprows=4, usecols=mock.ANY
     )
 
 
 def test_get_main_genie_clinical_sample_file_no_req_cols(
-    mock_synapse, mock_release_version
+    mock_synapse, mock_release_version, monkeypatch
 ):
     mock_syn, mock_release_files_table_synid = mock_synapse
 
     # Mock pandas.read_csv to return an empty DataFrame
-    pd.read_csv = mock.MagicMock(return_value=pd.DataFrame({"col1": [1, 2, 3]}))
+    monkeypatch.setattr(
+        pd, "read_csv", mock.MagicMock(return_value=pd.DataFrame({"col1": [1, 2, 3]}))
+    )
 
     # Call the function and assert the assertion error is raised
     with pytest.raises(
@@ -144,12 +158,14 @@ def test_get_main_genie_clinical_sample_file_no_req_cols(
         )
 
     mock_syn.tableQuery.assert_called_once_with(
-        f"SELECT * FROM {mock_release_files_table_synid}"
+        f"SELECT fileSynId FROM {mock_release_files_table_synid} "
+        f"WHERE release = '{mock_release_version}' "
+        "AND name = 'data_clinical_sample.txt'"
     )
     # Assert that syn.get was called in order
     mock_syn.get.assert_called_with("syn23456", followLink=True)
     pd.read_csv.assert_called_once_with(
-        "path/to/clinical_file.csv", sep="\t", skiprows=4
+        "path/to/clinical_file.csv", sep="\t", skiprows=4, usecols=mock.ANY
     )
 
 
@@ -162,3 +178,795 @@ def test_get_main_genie_clinical_sample_file_integration_test(config):
         release=config["main_genie_release_version"],
         release_files_table_synid=config["main_genie_data_release_files"],
     )
+
+
+def test_update_table_rows_sends_only_changes():
+    syn = mock.MagicMock()
+    logger = mock.MagicMock()
+    table_query = mock.MagicMock(etag="etag-1")
+    table_query.asDataFrame.return_value = pd.DataFrame(
+        {
+            "cohort": ["CRC", "CRC"],
+            "record_id": ["GENIE-1", "GENIE-2"],
+            "var_1": [1.0, 2.0],
+        },
+        index=["1_1", "2_1"],
+    )
+    new_data = pd.DataFrame(
+        {
+            "cohort": ["CRC", "CRC"],
+            "record_id": ["GENIE-1", "GENIE-3"],
+            "var_1": ["1", "3"],
+        }
+    )
+    with mock.patch.object(update_data_table, "Table") as patch_table:
+        update_data_table._update_table_rows(
+            syn, "schema", table_query, new_data, logger
+        )
+    table_query.asRowSet.assert_not_called()
+    # no update, one delete and one insert
+    assert patch_table.call_count == 2
+    delete_df = patch_table.call_args_list[0][0][1]
+    assert delete_df.index.tolist() == ["2_1"]
+    insert_df = patch_table.call_args_list[1][0][1]
+    assert insert_df["record_id"].tolist() == ["GENIE-3"]
+    syn.delete.assert_called_once()
+    syn.store.assert_called_once()
+
+
+def _annotated_schema(synid, annotations):
+    table_schema = mock.MagicMock(id=synid)
+    table_schema.get.side_effect = annotations.get
+    return table_schema
+
+
+@pytest.fixture
+def cohort_label_data():
+    label_data = utilities.partition_label_data(
+        pd.DataFrame(
+            {
+                "cohort": ["CRC", "CRC", "RENAL"],
+                "record_id": ["GENIE-1", "GENIE-2", "GENIE-3"],
+                "redcap_data_access_group": ["DFCI"] * 3,
+                "redcap_repeat_instrument": [np.nan] * 3,
+                "var_1": [1.0, 2.0, 3.0],
+            }
+        )
+    )
+    label_data.add_column("redacted")
+    return label_data
+
+
+def test_store_data_dry_run_is_not_resumed(cohort_label_data, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    syn = mock.MagicMock()
+    columns = ["cohort", "record_id", "redcap_data_access_group", "var_1"]
+    table_schema = _annotated_schema("syn1", {})
+    table_schema.form_label = ["non-repeating"]
+    syn.get.return_value = table_schema
+    syn.getColumns.return_value = [{"name": col} for col in columns]
+    logger = logging.getLogger("test_store_data")
+    inputs = {"table_type": "primary", "files": {"CRC": "syn5.1"}}
+    manifest = utilities.RunManifest(str(tmp_path / "run_manifest.json"))
+    manifest.start(inputs)
+    master_table = pd.DataFrame({"id": ["syn1"]})
+    with mock.patch.object(update_data_table, "_update_table_rows") as patch_update:
+        update_data_table.store_data(
+            syn,
+            master_table,
+            cohort_label_data,
+            "primary",
+            logger,
+            True,
+            manifest=manifest,
+        )
+        patch_update.assert_not_called()
+        assert (tmp_path / "syn1_temp.csv").exists()
+        assert not manifest.is_done("syn1", "stored")
+
+        # the real run resumed after the dry run stores the table
+        resumed = utilities.RunManifest(manifest.path)
+        resumed.start(inputs, resume=True)
+        update_data_table.store_data(
+            syn,
+            master_table,
+            cohort_label_data,
+            "primary",
+            logger,
+            False,
+            manifest=resumed,
+        )
+    patch_update.assert_called_once()
+    assert resumed.is_done("syn1", "stored")
+
+
+def test_store_data_dry_run_writes_parquet(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    label_data = utilities.partition_label_data(
+        pd.DataFrame(
+            {
+                "cohort": ["CRC", "CRC"],
+                "record_id": ["GENIE-1", "GENIE-2"],
+                "redcap_data_access_group": ["DFCI"] * 2,
+                "redcap_repeat_instrument": [np.nan] * 2,
+                "var_1": [1.0, 2.5],
+            }
+        )
+    )
+    syn = mock.MagicMock()
+    columns = ["cohort", "record_id", "redcap_data_access_group", "var_1"]
+    syn.get.return_value = mock.MagicMock(id="syn1", form_label=["non-repeating"])
+    syn.getColumns.return_value = [{"name": col} for col in columns]
+    update_data_table._store_data(
+        syn,
+        "syn1",
+        label_data,
+        "primary",
+        logging.getLogger("test_store_data"),
+        True,
+        output_format="parquet",
+    )
+    # the DOUBLE column holds both whole and fractional numbers
+    assert pd.read_parquet(tmp_path / "syn1_temp.parquet")["var_1"].tolist() == [
+        "1",
+        "2.5",
+    ]
+
+
+def test_store_data_incremental_rewrites_changed_cohorts(cohort_label_data):
+    syn = mock.MagicMock()
+    columns = ["cohort", "record_id", "redcap_data_access_group", "var_1"]
+    table_schema = _annotated_schema(
+        "syn1",
+        {
+            utilities.COHORT_VERSIONS_ANNOTATION: ["CRC=syn5.1", "RENAL=syn6.1"],
+            utilities.FINGERPRINT_ANNOTATION: ["abc"],
+        },
+    )
+    table_schema.form_label = ["non-repeating"]
+    table_schema.columnIds = columns
+    syn.get.return_value = table_schema
+    syn.getColumns.return_value = [{"name": col} for col in columns]
+    annotations = {
+        utilities.COHORT_VERSIONS_ANNOTATION: ["CRC=syn5.1", "RENAL=syn6.1"],
+        utilities.FINGERPRINT_ANNOTATION: ["abc"],
+    }
+    syn.get_annotations.return_value = annotations
+    input_versions = {"CRC": "syn5.1", "RENAL": "syn6.2"}
+    registry = utilities.TableSchemaRegistry(syn)
+    cohorts = utilities.get_changed_cohorts(registry, ["syn1"], input_versions)
+    assert cohorts == ["RENAL"]
+    with mock.patch.object(update_data_table, "_update_table_rows") as patch_update:
+        update_data_table.store_data(
+            syn,
+            pd.DataFrame({"id": ["syn1"]}),
+            cohort_label_data,
+            "primary",
+            logging.getLogger("test_store_data"),
+            False,
+            fingerprints=utilities.TableFingerprints(),
+            cohorts=cohorts,
+            registry=registry,
+        )
+    # the table is fetched once
+    syn.get.assert_called_once_with("syn1")
+    syn.getColumns.assert_called_once_with("syn1")
+    syn.tableQuery.assert_called_once_with(
+        "SELECT * FROM syn1 WHERE cohort IN ('RENAL')"
+    )
+    assert patch_update.call_args[0][3]["record_id"].tolist() == ["GENIE-3"]
+    # the loaded versions are only annotated once the table is snapshotted
+    syn.set_annotations.assert_not_called()
+    syn._waitForAsync.return_value = {"snapshotVersionNumber": 2}
+    utilities.snapshot_tables(
+        syn,
+        ["syn1"],
+        "",
+        logging.getLogger("test_store_data"),
+        input_versions=input_versions,
+        partial=True,
+    )
+    # the table is annotated with the loaded versions, its fingerprint is unknown
+    assert annotations == {
+        utilities.COHORT_VERSIONS_ANNOTATION: ["CRC=syn5.1", "RENAL=syn6.2"]
+    }
+    syn.set_annotations.assert_called_once_with(annotations)
+
+
+def test_store_rows_bounds_uploads_over_all_tables(monkeypatch):
+    monkeypatch.setattr(
+        update_data_table, "_UPLOAD_SLOTS", threading.BoundedSemaphore(2)
+    )
+    syn = mock.MagicMock()
+    lock = threading.Lock()
+    uploads = {"current": 0, "max": 0}
+
+    def _store(table):
+        with lock:
+            uploads["current"] += 1
+            uploads["max"] = max(uploads["max"], uploads["current"])
+        time.sleep(0.01)
+        with lock:
+            uploads["current"] -= 1
+
+    syn.store.side_effect = _store
+    df = pd.DataFrame({"record_id": ["GENIE-%s" % i for i in range(8)]})
+    logger = logging.getLogger("test_store_rows")
+    with mock.patch.object(update_data_table, "Table"):
+        utilities.run_concurrently(
+            lambda table_id, task_logger: update_data_table._store_rows(
+                syn, table_id, df, task_logger, chunk_bytes=1, workers=4
+            ),
+            ["syn1", "syn2", "syn3"],
+            3,
+            logger,
+        )
+    assert syn.store.call_count == 24
+    assert uploads["max"] == 2
+
+
+def test_store_data_irr_rerun_completes_failed_records(monkeypatch):
+    label_data = utilities.partition_label_data(
+        pd.DataFrame(
+            {
+                "cohort": ["CRC"] * 3,
+                "record_id": ["GENIE-1", "GENIE-2", "GENIE-1"],
+                "redcap_data_access_group": ["DFCI"] * 3,
+                "redcap_repeat_instrument": ["prissmm_imaging"] * 3,
+                "redcap_repeat_instance": [1.0, 1.0, 2.0],
+                "var_1": [1.0, 3.0, 2.0],
+            }
+        )
+    )
+    syn = mock.MagicMock()
+    columns = [
+        "cohort",
+        "record_id",
+        "redcap_data_access_group",
+        "redcap_repeat_instance",
+        "var_1",
+    ]
+    table_schema = mock.MagicMock(id="syn1", form_label=["prissmm_imaging"])
+    syn.get.return_value = table_schema
+    syn.getColumns.return_value = [{"name": col} for col in columns]
+    stored = []
+
+    def _store(rows):
+        # the chunk with the second instance of GENIE-1 fails
+        if fail and "2" in rows["var_1"].tolist():
+            raise requests.exceptions.ConnectionError()
+        stored.append(rows)
+
+    def _table_query(query, *args, **kwargs):
+        query_result = mock.MagicMock()
+        query_result.asDataFrame.return_value = pd.DataFrame(
+            {"record_id": [r for rows in stored for r in rows["record_id"]]}
+        )
+        return query_result
+
+    syn.store.side_effect = _store
+    syn.tableQuery.side_effect = _table_query
+    monkeypatch.setattr(
+        update_data_table,
+        "_store_rows",
+        functools.partial(update_data_table._store_rows, chunk_bytes=1),
+    )
+    logger = logging.getLogger("test_store_data")
+    with mock.patch.object(
+        update_data_table, "Table", side_effect=lambda schema, rows, **kwargs: rows
+    ):
+        fail = True
+        with pytest.raises(Exception):
+            update_data_table._store_data(syn, "syn1", label_data, "irr", logger, False)
+        fail = False
+        update_data_table._store_data(syn, "syn1", label_data, "irr", logger, False)
+    rows = pd.concat(stored)
+    # every row is stored once, including those of the failed record
+    assert sorted(zip(rows["record_id"], rows["redcap_repeat_instance"])) == [
+        ("GENIE-1", "1"),
+        ("GENIE-1", "2"),
+        ("GENIE-2", "1"),
+    ]
+
+
+def test_store_rows_uploads_chunks_without_retries():
+    syn = mock.MagicMock()
+    df = pd.DataFrame({"record_id": ["GENIE-%s" % i for i in range(10)]})
+    stored = []
+
+    def _store(table):
+        # the upload of the third chunk fails, it may have been committed
+        if len(stored) == 2:
+            stored.append(None)
+            raise requests.exceptions.ConnectionError()
+        stored.append(table)
+
+    syn.store.side_effect = _store
+    with mock.patch.object(update_data_table, "Table") as patch_table:
+        with pytest.raises(RuntimeError, match="1 of 9 row chunks failed"):
+            update_data_table._store_rows(
+                syn,
+                "schema",
+                df,
+                logging.getLogger("test_store_rows"),
+                etag="etag-1",
+                chunk_bytes=1,
+                workers=1,
+            )
+    chunks = [call[0][1] for call in patch_table.call_args_list]
+    # every chunk is stored once, the failed chunk is not sent again
+    assert [chunk["record_id"].tolist() for chunk in chunks] == [
+        [record_id] for record_id in df["record_id"]
+    ]
+    assert patch_table.call_args_list[0][1] == {"etag": "etag-1"}
+    assert all(call[1] == {} for call in patch_table.call_args_list[1:])
+
+
+def _legacy_to_redact_birth_year(
+    df_col_birth_year, df_col_dt_compare, df_col_vital_status
+):
+    # row by row implementation the vectorized version replaced
+    if len(df_col_dt_compare) == 0:
+        df_col_dt_compare = datetime.date.today()
+    else:
+        df_col_dt_compare = df_col_dt_compare.fillna(
+            datetime.datetime.now().strftime("%Y-%m-%d")
+        )
+        df_col_dt_compare = df_col_dt_compare.apply(
+            lambda x: datetime.datetime.strptime(str(x), "%Y-%m-%d").date()
+        )
+    df_col_birth_year = df_col_birth_year.fillna(1900)
+    df_col_birth_date = df_col_birth_year.apply(lambda x: datetime.date(int(x), 1, 1))
+    dates_diff = df_col_dt_compare - df_col_birth_date
+    dates_phi_bool = dates_diff.map(
+        lambda x: x.days > update_data_table.get_phi_cutoff("day")
+    )
+    to_redact = dates_phi_bool & (df_col_vital_status == "No")
+    return to_redact[to_redact].index
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_to_redact_birth_year_matches_legacy(seed):
+    rng = np.random.default_rng(seed)
+    n_rows = 500
+    birth_year = pd.Series(rng.integers(1900, 2010, n_rows).astype(float))
+    birth_year[rng.random(n_rows) < 0.1] = np.nan
+    dt_compare = pd.Series(
+        pd.Timestamp("1990-01-01")
+        + pd.to_timedelta(rng.integers(0, 40 * 365, n_rows), unit="D")
+    ).dt.strftime("%Y-%m-%d")
+    dt_compare = dt_compare.where(rng.random(n_rows) >= 0.1)
+    vital_status = pd.Series(rng.choice(["Yes", "No", np.nan], n_rows))
+    index = rng.permutation(n_rows) + 100
+    for col in (birth_year, dt_compare, vital_status):
+        col.index = index
+    result = update_data_table._to_redact_birth_year(
+        birth_year, dt_compare, vital_status
+    )
+    expected = _legacy_to_redact_birth_year(birth_year, dt_compare, vital_status)
+    assert len(expected) > 0
+    assert dt_compare.isnull().any()
+    pd.testing.assert_index_equal(result, expected)
+
+
+def test_to_redact_birth_year_empty():
+    empty = pd.Series([], dtype=object)
+    result = update_data_table._to_redact_birth_year(empty, empty, empty)
+    assert len(result) == 0
+
+
+def _legacy_redact_table(df, interval_cols_info):
+    # column by column implementation the 2-D version replaced
+    record_to_redact = list()
+    for col in set(interval_cols_info["variable"]).intersection(df.columns):
+        unit = interval_cols_info.loc[
+            interval_cols_info["variable"] == col, "unit"
+        ].values[0]
+        contain_greaterthan = df[col].astype(str).str.contains(">", na=False)
+        col_int = pd.to_numeric(df[col], errors="coerce")
+        to_redact = (
+            col_int > update_data_table.get_phi_cutoff(unit)
+        ) | contain_greaterthan
+        index_to_redact = to_redact.index[to_redact == True]
+        df.loc[index_to_redact, col] = ""
+        df[col] = df[col].map(utilities.float_to_int)
+        record_to_redact = record_to_redact + [
+            df["record_id"][x] for x in index_to_redact
+        ]
+    return df, record_to_redact
+
+
+@pytest.fixture
+def interval_cols_info():
+    return pd.DataFrame(
+        {
+            "variable": ["dx_days", "dx_months", "dx_years", "not_in_table"],
+            "unit": ["day", "month", "year", "day"],
+        }
+    )
+
+
+@pytest.mark.filterwarnings("ignore::FutureWarning")
+@pytest.mark.parametrize("seed", range(5))
+def test_redact_table_matches_legacy(interval_cols_info, seed):
+    rng = np.random.default_rng(seed)
+    n_rows = 300
+    df = pd.DataFrame(
+        {
+            "record_id": rng.choice(["GENIE-%s" % i for i in range(50)], n_rows),
+            "dx_days": rng.integers(0, 40000, n_rows).astype(float),
+            "dx_months": rng.integers(0, 1200, n_rows).astype(object),
+            "dx_years": rng.choice(["10", "95", ">89", "abc", np.nan], n_rows),
+            "other": rng.integers(0, 40000, n_rows),
+        }
+    )
+    df.loc[rng.random(n_rows) < 0.1, "dx_days"] = np.nan
+    cutoffs = update_data_table.get_interval_cutoffs(interval_cols_info)
+    result, records, counts = update_data_table._redact_table(df.copy(), cutoffs)
+    expected, expected_records = _legacy_redact_table(df.copy(), interval_cols_info)
+    pd.testing.assert_frame_equal(result, expected)
+    assert set(records) == set(expected_records)
+    assert len(records) == len(set(records))
+    assert counts.sum() == len(expected_records)
+    assert counts["dx_years"] == df["dx_years"].isin(["95", ">89"]).sum()
+
+
+def test_get_interval_cutoffs_invalid_unit(interval_cols_info):
+    interval_cols_info.loc[3, "unit"] = "week"
+    cutoffs = update_data_table.get_interval_cutoffs(interval_cols_info)
+    assert cutoffs["not_in_table"] is None
+    # only a table with the variable fails
+    df = pd.DataFrame({"record_id": ["GENIE-1"], "dx_days": ["40000"]})
+    _, records, _ = update_data_table._redact_table(df.copy(), cutoffs)
+    assert records.tolist() == ["GENIE-1"]
+    with pytest.raises(ValueError, match="Invalid unit for interval variables"):
+        update_data_table._redact_table(df.assign(not_in_table="1"), cutoffs)
+
+
+@pytest.fixture
+def redaction_tables(interval_cols_info):
+    # returns the mocked syn, full tables, redacted tables and stored data
+    syn = mock.MagicMock()
+    full_tables = pd.DataFrame(
+        {
+            "id": ["syn1", "syn2", "syn3", "syn4"],
+            "name": [
+                "Curation and QA",
+                "Patient Characteristics",
+                "Cancer Panel Test",
+                "Cancer Diagnosis",
+            ],
+        }
+    )
+    redacted_tables = pd.DataFrame(
+        {"id": ["syn11", "syn12", "syn13", "syn14"], "name": full_tables["name"]}
+    )
+    table_data = {
+        "syn1": pd.DataFrame(
+            {"record_id": ["GENIE-1", "GENIE-2"], "curation_dt": ["2020-01-01"] * 2}
+        ),
+        "syn2": pd.DataFrame(
+            {
+                "cohort": ["CRC", "CRC"],
+                "record_id": ["GENIE-1", "GENIE-2"],
+                "birth_year": ["1980", "1990"],
+                "hybrid_death_ind": ["No", "No"],
+                "redacted": [None, None],
+            }
+        ),
+        "syn4": pd.DataFrame(
+            {"record_id": ["GENIE-1", "GENIE-2"], "dx_days": ["100", "40000"]}
+        ),
+    }
+    cpt_data = pd.DataFrame(
+        {
+            "record_id": ["GENIE-1"],
+            "cpt_genie_sample_id": ["GENIE-1-1"],
+            "age_at_seq_report": [100.0],
+        }
+    )
+
+    def _table_query(query, *args, **kwargs):
+        query_result = mock.MagicMock()
+        if "syn3" in query:
+            query_result.asDataFrame.return_value = cpt_data
+        elif "syn23281483" in query:
+            query_result.asDataFrame.return_value = interval_cols_info
+        elif query == "SELECT cohort, record_id, redacted FROM syn2":
+            query_result.asDataFrame.return_value = pd.DataFrame(
+                {
+                    "cohort": ["CRC", "CRC"],
+                    "record_id": ["GENIE-1", "GENIE-2"],
+                    "redacted": ["No", "No"],
+                },
+                index=["1_1", "2_1"],
+            )
+        else:
+            query_result.asDataFrame.return_value = pd.DataFrame()
+        return query_result
+
+    syn.tableQuery.side_effect = _table_query
+    return syn, full_tables, redacted_tables, table_data
+
+
+def test_update_redact_table_uses_stored_table_data(redaction_tables):
+    syn, full_tables, redacted_tables, table_data = redaction_tables
+    logger = logging.getLogger("test_update_redact_table")
+    with mock.patch.object(
+        update_data_table, "_update_table_rows"
+    ) as patch_update, mock.patch.object(update_data_table, "Table") as patch_table:
+        update_data_table.update_redact_table(
+            syn, redacted_tables, full_tables, logger, table_data=table_data
+        )
+    full_queries = [
+        call[0][0]
+        for call in syn.tableQuery.call_args_list
+        if call[0][0].split()[-1] in table_data
+    ]
+    assert full_queries == ["SELECT cohort, record_id, redacted FROM syn2"]
+    # the Cancer Panel Test table falls back to Synapse
+    syn.tableQuery.assert_any_call("SELECT * FROM syn3")
+    patient_df = patch_update.call_args_list[-1][0][3]
+    assert patient_df["redacted"].tolist() == ["No", "Yes"]
+    assert patient_df["birth_year"].tolist() == ["1980", ""]
+    # the stored data is not changed by the redaction
+    assert table_data["syn4"]["dx_days"].tolist() == ["100", "40000"]
+    # only the patients whose redaction changed are updated in the full table
+    redacted_result = patch_table.call_args[0][1]
+    assert redacted_result.index.tolist() == ["2_1"]
+    assert redacted_result["redacted"].tolist() == ["Yes"]
+
+
+def test_update_redact_table_resets_previous_redaction(redaction_tables):
+    syn, full_tables, redacted_tables, table_data = redaction_tables
+    logger = logging.getLogger("test_update_redact_table")
+    # the patient table stored by a previous run redacted both patients
+    table_data["syn2"]["redacted"] = ["Yes", "Yes"]
+    with mock.patch.object(
+        update_data_table, "_update_table_rows"
+    ) as patch_update, mock.patch.object(update_data_table, "Table"):
+        update_data_table.update_redact_table(
+            syn, redacted_tables, full_tables, logger, table_data=table_data
+        )
+    patient_df = patch_update.call_args_list[-1][0][3]
+    assert patient_df["redacted"].tolist() == ["No", "Yes"]
+
+
+def test_upload_redacted_table_sends_new_redacted_flags():
+    syn = mock.MagicMock()
+    syn.tableQuery.return_value.asDataFrame.return_value = pd.DataFrame(
+        {
+            "cohort": ["CRC", "CRC"],
+            "record_id": ["GENIE-1", "GENIE-2"],
+            "birth_year": ["1980", ""],
+            "redacted": ["No", "Yes"],
+        },
+        index=["1_1", "2_1"],
+    )
+    new_df = pd.DataFrame(
+        {
+            "cohort": ["CRC", "CRC"],
+            "record_id": ["GENIE-1", "GENIE-2"],
+            "birth_year": ["", "1990"],
+            "redacted": ["Yes", "No"],
+        }
+    )
+    with mock.patch.object(update_data_table, "Table") as patch_table:
+        update_data_table._upload_redacted_table(
+            syn, mock.MagicMock(id="syn12"), new_df, logging.getLogger("test")
+        )
+    updated = patch_table.call_args_list[0][0][1]
+    assert updated.index.tolist() == ["1_1", "2_1"]
+    assert updated["redacted"].tolist() == ["Yes", "No"]
+    assert updated["birth_year"].tolist() == ["", "1990"]
+
+
+def test_update_redact_table_fails_before_patient_table(redaction_tables):
+    syn, full_tables, redacted_tables, table_data = redaction_tables
+    logger = logging.getLogger("test_update_redact_table")
+
+    def _get(synid):
+        if synid == "syn14":
+            raise ValueError("Cannot get %s" % synid)
+        return mock.MagicMock()
+
+    syn.get.side_effect = _get
+    with mock.patch.object(
+        update_data_table, "_update_table_rows"
+    ) as patch_update, mock.patch.object(update_data_table, "Table"):
+        with pytest.raises(RuntimeError, match="1 of 3 redacted tables failed"):
+            update_data_table.update_redact_table(
+                syn,
+                redacted_tables,
+                full_tables,
+                logger,
+                table_data=table_data,
+                workers=3,
+            )
+    # the other tables are still updated, the patient table is not
+    assert patch_update.call_count == 2
+
+
+def test_update_redact_table_resumes_from_manifest(redaction_tables, tmp_path):
+    syn, full_tables, redacted_tables, table_data = redaction_tables
+    logger = logging.getLogger("test_update_redact_table")
+    manifest = utilities.RunManifest(str(tmp_path / "run_manifest.json"))
+    manifest.start({"table_type": "primary"})
+
+    def _get(synid):
+        if synid == "syn13":
+            raise ValueError("Cannot get %s" % synid)
+        return mock.MagicMock()
+
+    syn.get.side_effect = _get
+    with mock.patch.object(
+        update_data_table, "_update_table_rows"
+    ) as patch_update, mock.patch.object(update_data_table, "Table"):
+        with pytest.raises(RuntimeError, match="1 of 3 redacted tables failed"):
+            update_data_table.update_redact_table(
+                syn,
+                redacted_tables,
+                full_tables,
+                logger,
+                table_data=table_data,
+                manifest=manifest,
+            )
+    assert manifest.is_done("syn14", "redacted")
+    assert not manifest.is_done("syn13", "redacted")
+    assert not manifest.is_done("syn12", "redacted")
+
+    syn.get.side_effect = None
+    resumed = utilities.RunManifest(manifest.path)
+    resumed.start({"table_type": "primary"}, resume=True)
+    with mock.patch.object(
+        update_data_table, "_update_table_rows"
+    ) as patch_update, mock.patch.object(update_data_table, "Table") as patch_table:
+        update_data_table.update_redact_table(
+            syn,
+            redacted_tables,
+            full_tables,
+            logger,
+            table_data=table_data,
+            manifest=resumed,
+        )
+    # only the failed table and the patient table are updated again
+    assert patch_update.call_count == 2
+    # the records redacted in the failed run are still used for the patients
+    patient_df = patch_update.call_args_list[-1][0][3]
+    assert patient_df["redacted"].tolist() == ["No", "Yes"]
+    assert patch_table.call_args[0][1]["redacted"].tolist() == ["Yes"]
+    assert resumed.is_done("syn12", "redacted")
+
+    with mock.patch.object(update_data_table, "_update_table_rows") as patch_update:
+        update_data_table.update_redact_table(
+            syn,
+            redacted_tables,
+            full_tables,
+            logger,
+            table_data=table_data,
+            manifest=resumed,
+        )
+    patch_update.assert_not_called()
+
+
+def test_update_redact_table_skips_unchanged_tables(redaction_tables):
+    syn, full_tables, redacted_tables, table_data = redaction_tables
+    logger = logging.getLogger("test_update_redact_table")
+    syn.get.side_effect = lambda synid: _annotated_schema(synid, {})
+    fingerprints = utilities.TableFingerprints()
+    with mock.patch.object(
+        update_data_table, "_update_table_rows"
+    ) as patch_update, mock.patch.object(update_data_table, "Table"):
+        update_data_table.update_redact_table(
+            syn,
+            redacted_tables,
+            full_tables,
+            logger,
+            table_data=table_data,
+            fingerprints=fingerprints,
+        )
+    assert patch_update.call_count == 4
+    assert fingerprints.skipped == set()
+    last_fingerprints = fingerprints.fingerprints
+
+    # the next run of the same data finds the fingerprints of the snapshots
+    syn.get.side_effect = lambda synid: _annotated_schema(
+        synid,
+        {utilities.FINGERPRINT_ANNOTATION: [last_fingerprints.get(synid)]},
+    )
+    fingerprints = utilities.TableFingerprints()
+    fingerprints.skipped.add("syn2")
+    with mock.patch.object(
+        update_data_table, "_update_table_rows"
+    ) as patch_update, mock.patch.object(update_data_table, "Table"):
+        update_data_table.update_redact_table(
+            syn,
+            redacted_tables,
+            full_tables,
+            logger,
+            table_data=table_data,
+            fingerprints=fingerprints,
+        )
+    patch_update.assert_not_called()
+    # the full patient table is snapshotted as its redacted column changed
+    assert fingerprints.skipped == {"syn11", "syn12", "syn13", "syn14"}
+
+
+def test_update_redact_table_keeps_unchanged_redacted_column(redaction_tables):
+    syn, full_tables, redacted_tables, table_data = redaction_tables
+    logger = logging.getLogger("test_update_redact_table")
+    table_query = syn.tableQuery.side_effect
+
+    def _table_query(query, *args, **kwargs):
+        query_result = table_query(query, *args, **kwargs)
+        if query.endswith("FROM syn2"):
+            query_result.asDataFrame.return_value["redacted"] = ["No", "Yes"]
+        return query_result
+
+    syn.tableQuery.side_effect = _table_query
+    fingerprints = utilities.TableFingerprints()
+    fingerprints.skipped.add("syn2")
+    with mock.patch.object(update_data_table, "_update_table_rows"), mock.patch.object(
+        update_data_table, "Table"
+    ):
+        update_data_table.update_redact_table(
+            syn,
+            redacted_tables,
+            full_tables,
+            logger,
+            table_data=table_data,
+            fingerprints=fingerprints,
+        )
+    syn.store.assert_not_called()
+    assert "syn2" in fingerprints.skipped
+
+
+def test_custom_fix_for_cancer_panel_test_table_stores_once(config):
+    syn = mock.MagicMock()
+    logger = mock.MagicMock()
+    master_table = pd.DataFrame(
+        {"id": ["syn1", "syn2"], "form_label": ["Cancer Panel Test", "Other"]}
+    )
+    cpt_query = mock.MagicMock(etag="etag-1")
+    cpt_query.asDataFrame.return_value = pd.DataFrame(
+        {
+            "cpt_genie_sample_id": ["GENIE-1-1", "GENIE-2-1", "GENIE-3-1"],
+            "cpt_sample_type": ["1", "Metastasis site unspecified", "8"],
+        },
+        index=["1_1", "2_1", "3_1"],
+    )
+    syn.tableQuery.return_value = cpt_query
+    genie_sample = pd.DataFrame(
+        {"SAMPLE_ID": ["GENIE-1-1", "GENIE-2-1"], "SEQ_YEAR": [2014.0, 2015.0]}
+    )
+    sample_type_mapping = pd.DataFrame(
+        {"CODE": [1, 8], "DESCRIPTION": ["Primary tumor", "Not applicable"]}
+    )
+    with mock.patch.object(
+        update_data_table,
+        "get_main_genie_clinical_sample_file",
+        return_value=genie_sample,
+    ), mock.patch.object(
+        update_data_table, "download_synapse_table", return_value=sample_type_mapping
+    ), mock.patch.object(
+        update_data_table, "Table"
+    ) as patch_table:
+        update_data_table.custom_fix_for_cancer_panel_test_table(
+            syn, master_table, logger, config
+        )
+    syn.get.assert_called_once_with("syn1")
+    syn.tableQuery.assert_called_once_with(
+        "SELECT cpt_genie_sample_id, cpt_sample_type FROM syn1"
+    )
+    syn.store.assert_called_once()
+    cpt_dat = patch_table.call_args[0][1]
+    assert patch_table.call_args[1] == {"etag": "etag-1"}
+    assert cpt_dat.index.tolist() == ["1_1", "2_1", "3_1"]
+    assert cpt_dat["cpt_seq_date"].tolist()[:2] == ["2014", "2015"]
+    assert pd.isna(cpt_dat["cpt_seq_date"].tolist()[2])
+    # only the codes 1 to 7 are mapped
+    assert cpt_dat["cpt_sample_type"].tolist() == [
+        "Primary tumor",
+        "Metastasis site unspecified",
+        "8",
+    ]
@@ -0,0 +1,732 @@
+import inspect
+import json
+import logging
+import time
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import pytest
+from synapseclient.core.exceptions import SynapseError
+
+from scripts.release import update_retraction_table
+from scripts.table_updates import utilities
+
+
+@pytest.fixture
+def label_df():
+    return pd.DataFrame(
+        {
+            "record_id": ["GENIE-1", "GENIE-2", "GENIE-3", "GENIE-4"],
+            "float_col": [1.0, 2.5, np.nan, -3.0],
+            "int_col": [1, 2, 3, 4],
+            "text_col": ["5.0", "abc", np.nan, ">32485"],
+            "mixed_col": np.array([1.0, "x", 2.5, np.nan], dtype=object),
+        },
+        index=[10, 11, 12, 13],
+    )
+
+
+def test_float_to_int_df_matches_float_to_int(label_df):
+    expected = label_df.apply(lambda col: col.map(utilities.float_to_int))
+    result = utilities.float_to_int_df(label_df)
+    pd.testing.assert_frame_equal(result, expected)
+    assert result["float_col"].tolist()[:2] == ["1", 2.5]
+    assert result["int_col"].tolist() == ["1", "2", "3", "4"]
+    assert result["text_col"].tolist()[0] == "5"
+
+
+def test_float_to_int_series_leaves_text_column_untouched():
+    col = pd.Series(["abc", "Yes", np.nan], name="text_col")
+    result = utilities.float_to_int_series(col)
+    pd.testing.assert_series_equal(result, col)
+
+
+def test_float_to_int_series_non_integral_floats_keep_dtype():
+    col = pd.Series([1.5, np.nan, 2.25])
+    result = utilities.float_to_int_series(col)
+    assert result.dtype == "float64"
+    pd.testing.assert_series_equal(result, col)
+
+
+def test_float_to_int_series_differs_from_float_to_int():
+    # integers above 2**53 are not rounded through a float
+    col = pd.Series([2**53 + 1, 3])
+    assert col.map(utilities.float_to_int).tolist() == ["9007199254740992", "3"]
+    assert utilities.float_to_int_series(col).tolist() == ["9007199254740993", "3"]
+    assert utilities.float_to_int_series(col.astype("Int64")).tolist()[0] == (
+        "9007199254740993"
+    )
+    # None is kept as missing instead of raising
+    col = pd.Series(["1.0", None])
+    with pytest.raises(TypeError):
+        col.map(utilities.float_to_int)
+    assert utilities.float_to_int_series(col).tolist() == ["1", None]
+
+
+@pytest.mark.parametrize(
+    "cols_to_skip",
+    [
+        ["record_id"],
+        ["record_id", "int_col"],
+    ],
+)
+def test_check_empty_rows_matches_check_empty_row(label_df, cols_to_skip):
+    label_df.loc[[11, 13], ["float_col", "text_col", "mixed_col"]] = np.nan
+    expected = label_df.apply(
+        lambda row: utilities.check_empty_row(row, cols_to_skip), axis=1
+    )
+    result = utilities.check_empty_rows(label_df, cols_to_skip)
+    assert result.equals(expected)
+    if "int_col" in cols_to_skip:
+        assert result.tolist() == [False, True, False, True]
+
+
+def test_partition_label_data():
+    label_data = pd.DataFrame(
+        {
+            "record_id": ["GENIE-1", "GENIE-1", "GENIE-2", "GENIE-2", "GENIE-3"],
+            "redcap_repeat_instrument": [
+                np.nan,
+                "prissmm_imaging",
+                np.nan,
+                "prissmm_imaging",
+                "prissmm_pathology",
+            ],
+            "var_1": [1.0, 2.0, 3.0, 4.0, 5.0],
+        }
+    )
+    partitions = utilities.partition_label_data(label_data)
+    assert set(partitions.forms) == {
+        "non-repeating",
+        "prissmm_imaging",
+        "prissmm_pathology",
+    }
+    assert partitions.get_table_columns(["var_1", "var_2", "record_id"]) == [
+        "var_1",
+        "record_id",
+    ]
+    result = partitions.get_form_data("prissmm_imaging", ["record_id", "var_1"])
+    expected = label_data.loc[
+        label_data["redcap_repeat_instrument"] == "prissmm_imaging",
+        ["record_id", "var_1"],
+    ]
+    pd.testing.assert_frame_equal(result, expected)
+    result = partitions.get_form_data("non-repeating", ["var_1"])
+    assert result.index.tolist() == [0, 2]
+    assert partitions.get_form_data("prissmm_md", ["var_1"]).empty
+
+
+def test_run_concurrently_orders_logs_and_isolates_failures(caplog):
+    logger = logging.getLogger("test_run_concurrently")
+    logger.setLevel(logging.DEBUG)
+    done = []
+
+    def _task(item, task_logger):
+        # later items finish first
+        time.sleep(0.01 * (4 - item))
+        task_logger.info("table %s" % item)
+        if item == 2:
+            raise ValueError("synapse timeout")
+        done.append(item)
+        return item * 10
+
+    with caplog.at_level(logging.INFO, logger="test_run_concurrently"):
+        with pytest.raises(RuntimeError, match="1 of 4 tables failed"):
+            utilities.run_concurrently(
+                _task, [0, 1, 2, 3], 4, logger, description="tables"
+            )
+    messages = [record.getMessage() for record in caplog.records]
+    assert [msg for msg in messages if msg.startswith("table")] == [
+        "table 0",
+        "table 1",
+        "table 2",
+        "table 3",
+    ]
+    assert sorted(done) == [0, 1, 3]
+    assert "Completed 3 of 4 tables" in messages
+
+
+def test_run_concurrently_returns_results_in_order():
+    logger = logging.getLogger("test_run_concurrently")
+    results = utilities.run_concurrently(
+        lambda item, _: item.upper(), ["b", "a"], 2, logger
+    )
+    assert list(results.items()) == [("b", "B"), ("a", "A")]
+
+
+def test_run_concurrently_logs_directly_with_one_worker(caplog):
+    logger = logging.getLogger("test_run_concurrently")
+
+    def _task(item, task_logger):
+        assert task_logger is logger
+        task_logger.info("table %s" % item)
+        return item
+
+    with caplog.at_level(logging.INFO, logger="test_run_concurrently"):
+        utilities.run_concurrently(_task, [1, 2], 1, logger, description="tables")
+    assert [(record.name, record.getMessage()) for record in caplog.records] == [
+        ("test_run_concurrently", "table 1"),
+        ("test_run_concurrently", "table 2"),
+        ("test_run_concurrently", "Completed 2 of 2 tables"),
+    ]
+
+
+@pytest.fixture
+def existing_table():
+    return pd.DataFrame(
+        {
+            "cohort": ["NSCLC", "NSCLC", "NSCLC", "NSCLC"],
+            "record_id": ["GENIE-1", "GENIE-2", "GENIE-3", "GENIE-4"],
+            "redcap_repeat_instance": [1, 1, 1, 2],
+            "var_1": [1.0, 2.0, np.nan, 5.0],
+        },
+        index=["1_1", "2_1", "3_2", "4_1"],
+    )
+
+
+def test_diff_table_rows(existing_table):
+    new = pd.DataFrame(
+        {
+            "cohort": ["NSCLC", "NSCLC", "NSCLC", "NSCLC"],
+            "record_id": ["GENIE-1", "GENIE-2", "GENIE-3", "GENIE-5"],
+            "redcap_repeat_instance": ["1", "1", "1", "1"],
+            "var_1": ["1", "3", np.nan, "7"],
+        }
+    )
+    to_insert, to_update, to_delete = utilities.diff_table_rows(
+        existing_table, new, ["cohort", "record_id", "redcap_repeat_instance"]
+    )
+    assert to_insert["record_id"].tolist() == ["GENIE-5"]
+    assert to_update.index.tolist() == ["2_1"]
+    assert to_update["var_1"].tolist() == ["3"]
+    assert to_delete.index.tolist() == ["4_1"]
+
+
+def test_diff_table_rows_keeps_redacted_column(existing_table):
+    existing_table["redacted"] = ["Yes", "No", "No", "No"]
+    new = existing_table.reset_index(drop=True).assign(redacted=np.nan)
+    new.loc[1, "var_1"] = 3.0
+    to_insert, to_update, to_delete = utilities.diff_table_rows(
+        existing_table,
+        new,
+        ["cohort", "record_id", "redcap_repeat_instance"],
+        ["redacted"],
+    )
+    # unchanged patients are not updated, changed ones keep their redaction
+    assert to_insert.empty and to_delete.empty
+    assert to_update.index.tolist() == ["2_1"]
+    assert to_update["redacted"].tolist() == ["No"]
+
+
+def test_diff_table_rows_duplicated_keys(existing_table):
+    new = existing_table.reset_index(drop=True)
+    new.loc[1, "record_id"] = "GENIE-1"
+    assert (
+        utilities.diff_table_rows(existing_table, new, ["cohort", "record_id"]) is None
+    )
+
+
+def test_record_id_index_reuses_ids_until_etag_changes(tmp_path):
+    syn = mock.MagicMock()
+    syn.tableQuery.return_value.etag = "etag-1"
+    syn.tableQuery.return_value.asDataFrame.return_value = pd.DataFrame(
+        {"record_id": ["GENIE-1", "GENIE-2", "GENIE-1"]}
+    )
+    index_path = str(tmp_path / "record_index.json")
+    record_index = utilities.RecordIdIndex(index_path)
+    assert record_index.get_record_ids(syn, "syn1") == {"GENIE-1", "GENIE-2"}
+    # the etag is not queried for a table that is not in the index
+    syn.tableQuery.assert_called_once_with("SELECT record_id FROM syn1")
+    record_index.save()
+
+    syn.reset_mock()
+    record_index = utilities.RecordIdIndex(index_path)
+    assert record_index.get_record_ids(syn, "syn1") == {"GENIE-1", "GENIE-2"}
+    syn.tableQuery.assert_called_once_with(
+        "SELECT * FROM syn1 LIMIT 1", resultsAs="rowset"
+    )
+
+    syn.tableQuery.return_value.etag = "etag-2"
+    record_index.get_record_ids(syn, "syn1")
+    syn.tableQuery.assert_called_with("SELECT record_id FROM syn1")
+
+
+@pytest.fixture
+def cohort_files(tmp_path):
+    paths = {}
+    for cohort, n_records in [("CRC", 3), ("RENAL", 2)]:
+        rows = []
+        for i in range(n_records):
+            rows.append(f"{cohort}-{i},,,1{i},NA")
+            rows.append(f"{cohort}-{i},prissmm_imaging,1,,2.5")
+            rows.append(f"{cohort}-{i},prissmm_imaging,2,,")
+        path = tmp_path / f"{cohort}.csv"
+        path.write_text(
+            "record_id,redcap_repeat_instrument,redcap_repeat_instance,"
+            "birth_year,image_scan\n" + "\n".join(rows) + "\n"
+        )
+        paths[f"syn_{cohort}"] = str(path)
+    syn = mock.MagicMock()
+    syn.get.side_effect = lambda synid: mock.MagicMock(path=paths[synid])
+    return syn, {"CRC": "syn_CRC", "RENAL": "syn_RENAL"}
+
+
+def test_stream_label_data_matches_partition_label_data(cohort_files, tmp_path):
+    syn, cohort_data_ids = cohort_files
+    label_data = pd.concat(
+        [
+            utilities.get_data(syn, synid, cohort)
+            for cohort, synid in cohort_data_ids.items()
+        ],
+        ignore_index=True,
+    )
+    expected = utilities.partition_label_data(label_data)
+    result = utilities.stream_label_data(
+        syn, cohort_data_ids, chunksize=4, path=str(tmp_path / "label_data")
+    )
+    assert set(result.forms) == set(expected.forms)
+    assert result.columns == expected.columns
+    columns = ["cohort", "record_id", "birth_year", "image_scan"]
+    for form_label in expected.forms:
+        pd.testing.assert_frame_equal(
+            result.get_form_data(form_label, columns),
+            expected.get_form_data(form_label, columns),
+            check_dtype=False,
+        )
+    # columns without data are not kept for the form
+    for form_path in result.forms["prissmm_imaging"]:
+        assert "birth_year" not in pd.read_parquet(form_path).columns
+
+
+def test_get_cohort_data_concurrent_keeps_cohort_order(cohort_files):
+    syn, cohort_data_ids = cohort_files
+    expected = pd.concat(
+        [
+            utilities.get_data(syn, synid, cohort)
+            for cohort, synid in cohort_data_ids.items()
+        ],
+        ignore_index=True,
+    )
+    get_file = syn.get.side_effect
+
+    def _slow_first_cohort(synid):
+        # the first cohort completes last
+        if synid == "syn_CRC":
+            time.sleep(0.2)
+        return get_file(synid)
+
+    syn.get.side_effect = _slow_first_cohort
+    result = utilities.get_cohort_data(
+        syn, cohort_data_ids, logging.getLogger("test"), workers=2
+    )
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_parquet_label_data_matches_label_data(cohort_files, tmp_path):
+    pytest.importorskip("pyarrow")
+    syn, cohort_data_ids = cohort_files
+    expected = utilities.stream_label_data(
+        syn, cohort_data_ids, chunksize=4, path=str(tmp_path / "stream")
+    )
+    utilities.write_label_data_parquet(expected, str(tmp_path / "label_data"))
+    result = utilities.ParquetLabelData(str(tmp_path / "label_data"))
+    assert set(result.forms) == set(expected.forms)
+    assert result.columns == expected.columns
+    columns = ["cohort", "record_id", "birth_year", "image_scan"]
+    for form_label in list(expected.forms) + ["missing_form"]:
+        pd.testing.assert_frame_equal(
+            utilities.float_to_int_df(result.get_form_data(form_label, columns)),
+            utilities.float_to_int_df(expected.get_form_data(form_label, columns)),
+            check_dtype=False,
+        )
+
+
+def test_parquet_label_data_keeps_input_versions(cohort_files, tmp_path):
+    pytest.importorskip("pyarrow")
+    syn, cohort_data_ids = cohort_files
+    input_versions = {"CRC": "syn_CRC.3", "RENAL": "syn_RENAL.1"}
+    stream_path = str(tmp_path / "stream")
+    label_data = utilities.stream_label_data(
+        syn, cohort_data_ids, 4, stream_path, input_versions=input_versions
+    )
+    assert utilities.get_label_data_versions(stream_path) == input_versions
+    path = str(tmp_path / "label_data")
+    utilities.write_label_data_parquet(label_data, path, {"CRC": "syn_CRC.2"})
+    assert utilities.get_label_data_versions(path) == {"CRC": "syn_CRC.2"}
+    # label data written without its versions can not be used for a run
+    utilities.write_label_data_parquet(label_data, str(tmp_path / "old"))
+    with pytest.raises(ValueError, match="has no input versions"):
+        utilities.get_label_data_versions(str(tmp_path / "old"))
+
+
+@pytest.fixture
+def data_element_catalog():
+    return pd.DataFrame(
+        {
+            "variable": ["birth_year", "image_scan", "image_ca", "naaccr_race"],
+            "type": ["text", "text", "checkbox", "dropdown"],
+            "synColType": ["INTEGER", "DOUBLE", "STRING", "STRING"],
+            "colLabels": [np.nan, np.nan, "1,2", np.nan],
+        }
+    )
+
+
+def test_get_catalog_dtypes(data_element_catalog):
+    assert utilities.get_catalog_dtypes(data_element_catalog) == {
+        "birth_year": "Int64",
+        "image_scan": "float64",
+        "image_ca___1": "category",
+        "image_ca___2": "category",
+        "naaccr_race": "category",
+    }
+
+
+def test_catalog_dtypes_give_same_normalized_data(cohort_files, data_element_catalog):
+    syn, cohort_data_ids = cohort_files
+    dtypes = utilities.get_catalog_dtypes(data_element_catalog)
+    columns = ["cohort", "record_id", "birth_year", "image_scan"]
+    results = []
+    for dtype_map in [None, dtypes]:
+        label_data = utilities.concat_label_data(
+            [
+                utilities.get_data(syn, synid, cohort, dtype_map)
+                for cohort, synid in cohort_data_ids.items()
+            ],
+            ignore_index=True,
+        )
+        results.append(utilities.float_to_int_df(label_data[columns]))
+    pd.testing.assert_frame_equal(results[0], results[1])
+
+
+@pytest.mark.parametrize("file_format", ["csv", "parquet"])
+def test_stream_label_data_reads_chunks_with_same_dtypes(
+    data_element_catalog, tmp_path, file_format
+):
+    # the values changing the dtype of a column are only in the last chunk
+    label_data = pd.DataFrame(
+        {
+            "record_id": ["GENIE-%s" % i for i in range(6)],
+            "redcap_repeat_instrument": [np.nan] * 6,
+            "birth_year": ["1980", "1981", "1982", "1983", "1984", ">1985"],
+            "image_scan": ["1", "2", "3", "4", "5", "6.5"],
+            "naaccr_race": ["1", "2", "1", "2", "1", "White"],
+        }
+    )
+    path = str(tmp_path / ("CRC." + file_format))
+    if file_format == "csv":
+        label_data.to_csv(path, index=False)
+    else:
+        label_data.to_parquet(path)
+    syn = mock.MagicMock()
+    syn.get.return_value = mock.MagicMock(path=path)
+    dtypes = utilities.get_catalog_dtypes(data_element_catalog)
+    result = utilities.stream_label_data(
+        syn, {"CRC": "syn1"}, 2, str(tmp_path / "label_data"), dtypes
+    )
+    parts = [pd.read_parquet(part) for part in result.forms["non-repeating"]]
+    assert len(parts) == 3
+    for col in ["birth_year", "image_scan", "naaccr_race"]:
+        assert len({str(part[col].dtype) for part in parts}) == 1
+    assert parts[0]["birth_year"].tolist() == ["1980", "1981"]
+    assert str(parts[0]["naaccr_race"].dtype) == "category"
+    columns = ["record_id", "birth_year", "image_scan", "naaccr_race"]
+    pd.testing.assert_frame_equal(
+        utilities.float_to_int_df(result.get_form_data("non-repeating", columns)),
+        utilities.float_to_int_df(label_data[columns]).astype(object),
+        check_dtype=False,
+        check_categorical=False,
+    )
+
+
+def test_apply_catalog_dtypes_keeps_lossy_columns():
+    df = pd.DataFrame(
+        {
+            "birth_year": [1950.0, np.nan],
+            "dob_ca_dx_days": ["100", ">32485"],
+            "naaccr_race": ["White", np.nan],
+        }
+    )
+    dtypes = {
+        "birth_year": "Int64",
+        "dob_ca_dx_days": "Int64",
+        "naaccr_race": "category",
+    }
+    result = utilities.apply_catalog_dtypes(df, dtypes)
+    assert result["birth_year"].dtype == "Int64"
+    assert result["dob_ca_dx_days"].dtype == object
+    assert result["naaccr_race"].dtype == "category"
+
+
+def test_concat_label_data_keeps_categories():
+    frames = [
+        pd.DataFrame({"naaccr_race": pd.Categorical(["White"])}),
+        pd.DataFrame({"naaccr_race": pd.Categorical(["Asian", np.nan])}),
+    ]
+    result = utilities.concat_label_data(frames, ignore_index=True)
+    assert result["naaccr_race"].dtype == "category"
+    assert result["naaccr_race"].tolist()[:2] == ["White", "Asian"]
+
+
+def test_synapse_cache_round_trip_and_eviction(tmp_path):
+    pytest.importorskip("pyarrow")
+    cache = utilities.SynapseCache(str(tmp_path))
+    df = pd.DataFrame({"record_id": ["GENIE-1", "GENIE-2"]}, index=["1_1", "2_1"])
+    cache.put(["query", "SELECT * FROM syn1", "etag-1"], df)
+    pd.testing.assert_frame_equal(
+        utilities.SynapseCache(str(tmp_path)).get(
+            ["query", "SELECT * FROM syn1", "etag-1"]
+        ),
+        df,
+    )
+    assert cache.get(["query", "SELECT * FROM syn1", "etag-2"]) is None
+    # only the most recent entry fits
+    cache.max_size = max(entry["size"] for entry in cache.entries.values())
+    cache.put(["file", "syn2", 1], df)
+    assert cache.get(["query", "SELECT * FROM syn1", "etag-1"]) is None
+    assert cache.get(["file", "syn2", 1]) is not None
+
+
+def test_cached_table_query_skips_download_for_same_etag(tmp_path):
+    pytest.importorskip("pyarrow")
+    syn = mock.MagicMock()
+    syn.tableQuery.return_value.etag = "etag-1"
+    syn.tableQuery.return_value.asDataFrame.return_value = pd.DataFrame(
+        {"variable": ["birth_year"]}
+    )
+    cache = utilities.SynapseCache(str(tmp_path))
+    for _ in range(2):
+        result = utilities.cached_table_query(
+            syn, "SELECT * FROM syn21431364", "syn21431364", cache
+        )
+        assert result["variable"].tolist() == ["birth_year"]
+    full_queries = [
+        query
+        for query in syn.tableQuery.call_args_list
+        if query == mock.call("SELECT * FROM syn21431364")
+    ]
+    assert len(full_queries) == 1
+
+
+@pytest.mark.parametrize(
+    "columns,condition,expected",
+    [
+        (None, None, "SELECT * FROM syn1"),
+        (["id", "name"], "", "SELECT id, name FROM syn1"),
+        (None, "table_type='data'", "SELECT * FROM syn1 WHERE table_type='data'"),
+        (
+            ["id"],
+            {"cohort": "O'Neil", "current": True, "version": 2},
+            "SELECT id FROM syn1 WHERE cohort = 'O''Neil' "
+            "AND current = true AND version = 2",
+        ),
+        (
+            ["cpt_sample_type"],
+            {"cpt_sample_type": [1, 2, 3]},
+            "SELECT cpt_sample_type FROM syn1 WHERE cpt_sample_type IN (1, 2, 3)",
+        ),
+        (
+            None,
+            {"cpt_sample_type": list(np.array([1, 2])), "redacted": np.bool_(True)},
+            "SELECT * FROM syn1 WHERE cpt_sample_type IN (1, 2) AND redacted = true",
+        ),
+    ],
+)
+@pytest.mark.parametrize("module", [utilities, update_retraction_table])
+def test_build_table_query(module, columns, condition, expected):
+    assert module.build_table_query("syn1", columns, condition) == expected
+
+
+@pytest.mark.parametrize("function", ["_format_sql_value", "build_table_query"])
+def test_build_table_query_copies_match_utilities(function):
+    assert inspect.getsource(
+        getattr(update_retraction_table, function)
+    ) == inspect.getsource(getattr(utilities, function))
+
+
+def test_snapshot_tables_creates_a_version_of_each_table():
+    syn = mock.MagicMock()
+    syn._waitForAsync.side_effect = lambda uri, request: {
+        "jobState": "COMPLETE",
+        "snapshotVersionNumber": {"syn1": 4, "syn2": 7}[request["entityId"]],
+    }
+    versions = utilities.snapshot_tables(
+        syn, ["syn1", "syn2"], 'Release "1.0"', logging.getLogger("test"), workers=2
+    )
+    assert versions == {"syn1": 4, "syn2": 7}
+    uri, request = syn._waitForAsync.call_args_list[0][0]
+    assert uri.startswith("/entity/syn") and uri.endswith("/table/transaction/async")
+    assert request["createSnapshot"] is True
+    assert request["snapshotOptions"] == {"snapshotComment": 'Release "1.0"'}
+
+
+def test_snapshot_tables_does_not_retry_failed_snapshots():
+    syn = mock.MagicMock()
+    syn._waitForAsync.side_effect = SynapseError("snapshot failed")
+    with pytest.raises(RuntimeError, match="1 of 1 table snapshots failed"):
+        utilities.snapshot_tables(syn, ["syn1"], "", logging.getLogger("test"))
+    syn._waitForAsync.assert_called_once()
+    syn.restPOST.assert_not_called()
+
+
+def test_run_manifest_resumes_only_same_inputs(tmp_path, monkeypatch):
+    monkeypatch.setattr(utilities.time, "sleep", mock.MagicMock())
+    path = str(tmp_path / "run_manifest.json")
+    inputs = {"table_type": "primary", "files": {"CRC": "syn1.2"}}
+    manifest = utilities.RunManifest(path)
+    manifest.start(inputs)
+    manifest.set_done("syn1", "stored")
+    manifest.set_done("syn1", "snapshotted")
+
+    resumed = utilities.RunManifest(path)
+    resumed.start(inputs, resume=True)
+    assert resumed.is_done("syn1", "stored")
+    syn = mock.MagicMock()
+    syn._waitForAsync.return_value = {
+        "jobState": "COMPLETE",
+        "snapshotVersionNumber": 3,
+    }
+    versions = utilities.snapshot_tables(
+        syn, ["syn1", "syn2"], "", logging.getLogger("test"), manifest=resumed
+    )
+    assert versions == {"syn2": 3}
+    assert resumed.is_done("syn2", "snapshotted")
+
+    changed = utilities.RunManifest(path)
+    with pytest.raises(ValueError, match="can not be resumed"):
+        changed.start({"table_type": "primary", "files": {"CRC": "syn1.3"}}, True)
+    # a new run starts from scratch
+    changed.start(inputs)
+    assert not changed.is_done("syn1", "stored")
+
+
+def test_get_table_fingerprint():
+    df = pd.DataFrame({"record_id": ["GENIE-1", "GENIE-2"], "dx_days": [100.0, None]})
+    fingerprint = utilities.get_table_fingerprint(df)
+    assert fingerprint == utilities.get_table_fingerprint(
+        pd.DataFrame({"dx_days": [None, "100"], "record_id": ["GENIE-2", "GENIE-1"]})
+    )
+    assert fingerprint != utilities.get_table_fingerprint(
+        df.assign(dx_days=[101.0, None])
+    )
+    assert fingerprint != utilities.get_table_fingerprint(
+        df.rename(columns={"dx_days": "dx_months"})
+    )
+
+
+def test_snapshot_tables_skips_unchanged_tables(monkeypatch):
+    monkeypatch.setattr(utilities.time, "sleep", mock.MagicMock())
+    df = pd.DataFrame({"record_id": ["GENIE-1"]})
+    fingerprint = utilities.get_table_fingerprint(df)
+    fingerprints = utilities.TableFingerprints()
+    unchanged = {utilities.FINGERPRINT_ANNOTATION: [fingerprint]}
+    assert not fingerprints.has_changed(
+        mock.MagicMock(id="syn1", **{"get.side_effect": unchanged.get}), df
+    )
+    assert fingerprints.has_changed(
+        mock.MagicMock(id="syn2", **{"get.side_effect": {}.get}), df
+    )
+    syn = mock.MagicMock()
+    syn._waitForAsync.return_value = {
+        "jobState": "COMPLETE",
+        "snapshotVersionNumber": 3,
+    }
+    annotations = {}
+    syn.get_annotations.return_value = annotations
+    versions = utilities.snapshot_tables(
+        syn, ["syn1", "syn2"], "", logging.getLogger("test"), fingerprints=fingerprints
+    )
+    assert versions == {"syn2": 3}
+    syn.get_annotations.assert_called_once_with("syn2")
+    syn.set_annotations.assert_called_once_with(
+        {utilities.FINGERPRINT_ANNOTATION: fingerprint}
+    )
+
+
+def test_snapshot_tables_annotates_loaded_versions_of_unchanged_tables():
+    fingerprints = utilities.TableFingerprints()
+    fingerprints.skipped.add("syn1")
+    syn = mock.MagicMock()
+    syn._waitForAsync.return_value = {"snapshotVersionNumber": 3}
+    annotations = {"syn1": {}, "syn2": {}}
+    syn.get_annotations.side_effect = annotations.get
+    versions = utilities.snapshot_tables(
+        syn,
+        ["syn1", "syn2"],
+        "",
+        logging.getLogger("test"),
+        fingerprints=fingerprints,
+        input_versions={"CRC": "syn5.2"},
+    )
+    assert versions == {"syn2": 3}
+    assert annotations == {
+        "syn1": {utilities.COHORT_VERSIONS_ANNOTATION: ["CRC=syn5.2"]},
+        "syn2": {utilities.COHORT_VERSIONS_ANNOTATION: ["CRC=syn5.2"]},
+    }
+
+
+def test_snapshot_tables_does_not_annotate_failed_snapshots():
+    syn = mock.MagicMock()
+    syn._waitForAsync.side_effect = SynapseError("snapshot failed")
+    with pytest.raises(RuntimeError):
+        utilities.snapshot_tables(
+            syn,
+            ["syn1"],
+            "",
+            logging.getLogger("test"),
+            input_versions={"CRC": "syn5.2"},
+        )
+    syn.set_annotations.assert_not_called()
+
+
+def test_table_schema_registry_fetches_tables_once():
+    syn = mock.MagicMock()
+    syn.get.side_effect = lambda table_id: mock.MagicMock(id=table_id)
+    syn.getColumns.side_effect = lambda table_id: iter(
+        [{"name": "record_id"}, {"name": "var_%s" % table_id}]
+    )
+    registry = utilities.TableSchemaRegistry(syn)
+    registry.prefetch(["syn1", "syn2", "syn1"], logging.getLogger("test"), workers=2)
+    assert syn.get.call_count == 2
+    assert registry.get("syn2").id == "syn2"
+    assert registry.get_column_names("syn1") == ["record_id", "var_syn1"]
+    assert registry.get_column_name_set("syn2") == {"record_id", "var_syn2"}
+    assert syn.get.call_count == 2
+    assert syn.getColumns.call_count == 2
+    # tables that were not prefetched are fetched on first use
+    assert registry.get_columns("syn3") == [{"name": "record_id"}, {"name": "var_syn3"}]
+    registry.get("syn3")
+    assert syn.get.call_count == 3
+    # the columns of a stored table are fetched again
+    registry.update(mock.MagicMock(id="syn1"))
+    assert syn.getColumns.call_count == 4
+
+
+def test_stage_metrics_records_and_writes(tmp_path):
+    metrics = utilities.StageMetrics()
+    with metrics.stage("upload", "syn1") as record:
+        record["rows"], record["columns"] = 10, 3
+        record["bytes"] = 2048
+    with pytest.raises(ValueError):
+        with metrics.stage("redaction", "syn2"):
+            raise ValueError("failed stage")
+    assert [record["stage"] for record in metrics.records] == ["upload", "redaction"]
+    assert metrics.records[0]["wall_time"] >= 0
+    assert metrics.records[0]["peak_rss"] > 0
+    metrics.write(str(tmp_path / "metrics"))
+    with open(tmp_path / "metrics.json") as metrics_file:
+        assert json.load(metrics_file)[0]["bytes"] == 2048
+    metrics_df = pd.read_csv(tmp_path / "metrics.csv")
+    assert metrics_df.columns.tolist() == utilities.StageMetrics.FIELDS
+    assert metrics_df["table"].tolist() == ["syn1", "syn2"]
+
+
+def test_get_data_records_download_and_parse(cohort_files):
+    syn, cohort_data_ids = cohort_files
+    utilities.STAGE_METRICS.clear()
+    utilities.get_data(syn, "syn_CRC", "CRC")
+    download, parse = utilities.STAGE_METRICS.records
+    assert (download["stage"], download["table"]) == ("download", "syn_CRC")
+    assert download["bytes"] > 0
+    assert (parse["stage"], parse["rows"], parse["columns"]) == ("parse", 9, 5)
+    utilities.STAGE_METRICS.clear()